@@ -0,0 +1,173 @@
+# Copyright 2020 N26 GmbH
+# Copyright 2022 Dmitry Kisler <admin@dkisler.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+
+"""Benchmarks the query.
+
+The aggregation of transactions is benchmarked in memory on the non-blocked transactions of active users, i.e. on the
+rows which pass the filter and join conditions: the rows of `transactions.csv` are read upfront, so the file I/O is
+excluded from the measurements. The query engines are benchmarked end-to-end.
+"""
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from typing import Callable
+from uuid import UUID
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "solution"))
+
+from main import (  # noqa: E402
+    ENGINE_PYTHON,
+    ENGINE_SQLITE,
+    CSVReader,
+    QueryResult,
+    TransactionCategoryKPICalc,
+    _is_true,
+    aggregate_transactions,
+    main,
+    new_not_blocked_transaction,
+    read_active_users,
+)
+
+
+def aggregate_transaction_objects(result: QueryResult, rows: list[list[str]], active_users: set[UUID]) -> QueryResult:
+    """Aggregates the rows the way it was done before the allocation-free path.
+
+    A ``Transaction`` object is created per row, and a default accumulator is created per lookup.
+    """
+    for row in rows:
+        transaction = new_not_blocked_transaction(row)
+
+        if transaction is None or transaction.user_id not in active_users:
+            continue
+
+        kpi = result.get(transaction.transaction_category_id, TransactionCategoryKPICalc())
+        kpi.add_transaction(transaction)
+        result[transaction.transaction_category_id] = kpi
+
+    return result
+
+
+def count_allocations(
+    fn: Callable[[QueryResult, list[list[str]], set[UUID]], QueryResult],
+    result: QueryResult,
+    row: list[str],
+    active_users: set[UUID],
+) -> int:
+    """Counts the memory blocks allocated while a single row is aggregated, including the blocks freed right away.
+
+    The blocks traced with tracemalloc are sampled on every function call and return, the blocks allocated by the
+    sampling itself are excluded. The blocks allocated and freed between two samples are not counted.
+    """
+    ignored = [tracemalloc.Filter(False, __file__), tracemalloc.Filter(False, tracemalloc.__file__)]
+    blocks: set[tracemalloc.Trace] = set()
+
+    def sample(*args: object) -> None:
+        blocks.update(tracemalloc.take_snapshot().filter_traces(ignored).traces)
+
+    tracemalloc.start()
+    sys.setprofile(sample)
+
+    try:
+        fn(result, [row], active_users)
+    finally:
+        sys.setprofile(None)
+        tracemalloc.stop()
+
+    return len(blocks)
+
+
+def measure(
+    fn: Callable[[QueryResult, list[list[str]], set[UUID]], QueryResult],
+    rows: list[list[str]],
+    active_users: set[UUID],
+    num_rows_allocations: int = 100,
+) -> str:
+    # warm-up: all categories and users are added, so the measured passes do not grow the result
+    result = fn(QueryResult(), rows, active_users)
+    gc.collect()
+
+    t0 = time.perf_counter()
+    fn(result, rows, active_users)
+    elapsed = time.perf_counter() - t0
+
+    # the peak of memory traced while a single row is aggregated is the per-row allocation churn
+    churn: int = 0
+    batches = [[row] for row in rows]
+
+    tracemalloc.start()
+
+    for batch in batches:
+        current = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(result, batch, active_users)
+        churn += tracemalloc.get_traced_memory()[1] - current
+
+    tracemalloc.stop()
+
+    # the allocations are sampled on every call, so they are counted on a subset of rows
+    sampled = rows[:num_rows_allocations]
+    allocations = sum(count_allocations(fn, result, row, active_users) for row in sampled)
+
+    return "%-30s %10.3f us/row %10.1f peak allocated bytes/row %6.1f allocated blocks/row" % (
+        fn.__name__,
+        elapsed / len(rows) * 1_000_000,
+        churn / len(rows),
+        allocations / len(sampled),
+    )
+
+
+def measure_engine(engine: str, path_users: str, path_transactions: str) -> tuple[str, str]:
+    t0 = time.perf_counter()
+    result = main(path_users, path_transactions, engine=engine)
+    elapsed = time.perf_counter() - t0
+
+    return "%-30s %10.3f sec." % (engine, elapsed), result.__str__()
+
+
+if __name__ == "__main__":
+    base_dir = os.getenv("BASE_DIR", "fixtures")
+    num_rows = int(os.getenv("NUM_ROWS", "100000"))
+
+    active_users = read_active_users(CSVReader(f"{base_dir}/users.csv"))
+
+    rows: list[list[str]] = []
+    for row in CSVReader(f"{base_dir}/transactions.csv"):
+        if not _is_true(row[3]) and UUID(row[2]) in active_users:
+            rows.append(row)
+            if len(rows) >= num_rows:
+                break
+
+    print("aggregate %d non-blocked transactions of %d active users" % (len(rows), len(active_users)))
+
+    for fn in (aggregate_transaction_objects, aggregate_transactions):
+        print(measure(fn, rows, active_users))
+
+    print("run the query with every engine")
+
+    results: set[str] = set()
+    for engine in (ENGINE_PYTHON, ENGINE_SQLITE):
+        report, result = measure_engine(engine, f"{base_dir}/users.csv", f"{base_dir}/transactions.csv")
+        results.add(result)
+        print(report)
+
+    if len(results) != 1:
+        sys.exit("the results of engines do not match")
@@ -19,13 +19,43 @@
 # SOFTWARE.
 
 """Application to process and join tables."""
+import argparse
+import asyncio
+import json
 import logging
+import math
 import os
+import random
+import signal
+import sqlite3
+import struct
+import sys
+import threading
 import time
+import tracemalloc
+import zlib
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import date
+from itertools import accumulate, chain, islice
 from operator import itemgetter
-from typing import Optional
+from statistics import NormalDist
+from types import FrameType
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, TypeVar, Union, overload
 from uuid import UUID
 
+logs = logging.getLogger("joiner")
+
+# Functions called with the stage name at the stage boundaries of the query, see ``AllocationTracer``.
+_stage_hooks: list[Callable[[str], None]] = []
+
+
+def _stage(name: str) -> None:
+    """Marks the end of the query stage."""
+    for hook in _stage_hooks:
+        hook(name)
+
 
 class CSVReader:
     """Reads the csv file."""
@@ -62,9 +92,114 @@ class CSVReader:
             raise e
 
 
+class IndexedReader:
+    """Reads the csv file rows starting at the given byte offsets.
+
+    The rows are read with ``os.pread``, a short read per row by default. The offsets have to be sorted, so the rows
+    separated by the gap of at most ``max_gap`` bytes are fetched in a single call, the bytes in between are read too.
+    """
+
+    def __init__(self, path: str, offsets: Iterable[int], max_gap: int = 0) -> None:
+        self.path = path
+        self.offsets = offsets
+        self.max_gap = max_gap
+        self.row_id = -1
+
+    def __iter__(self) -> Iterator[list[str]]:
+        fd = os.open(self.path, os.O_RDONLY)
+
+        try:
+            batch: list[int] = []
+
+            for offset in self.offsets:
+                if len(batch) > 0 and offset - batch[-1] > self.max_gap:
+                    yield from self._read_batch(fd, batch)
+                    batch = []
+
+                batch.append(offset)
+
+            yield from self._read_batch(fd, batch)
+        finally:
+            os.close(fd)
+
+    def _read_batch(self, fd: int, batch: list[int]) -> Iterator[list[str]]:
+        if len(batch) == 0:
+            return
+
+        start = batch[0]
+        buf = os.pread(fd, batch[-1] - start + 256, start)
+
+        for offset in batch:
+            i = offset - start
+            j = buf.find(b"\n", i)
+
+            while j == -1:
+                # the row is longer than expected, or the last line has no line break
+                chunk = os.pread(fd, 4096, start + len(buf))
+                if chunk:
+                    buf += chunk
+                    j = buf.find(b"\n", i)
+                else:
+                    j = len(buf)
+
+            self.row_id += 1
+            yield buf[i:j].decode().rstrip().split(",")
+
+
+class RangeReader:
+    """Reads the csv file rows within the given byte ranges.
+
+    The ranges have to start at the row beginning, and to end at the row end, or at the end of file.
+    """
+
+    def __init__(self, path: str, ranges: Iterable[tuple[int, int]], chunk_size: int = 1024 * 1024) -> None:
+        self.path = path
+        self.ranges = ranges
+        self.chunk_size = chunk_size
+        self.row_id = -1
+
+    def __iter__(self) -> Iterator[list[str]]:
+        fd = os.open(self.path, os.O_RDONLY)
+
+        try:
+            for start, end in self.ranges:
+                yield from self._read_range(fd, start, end)
+        finally:
+            os.close(fd)
+
+    def _read_range(self, fd: int, start: int, end: int) -> Iterator[list[str]]:
+        tail: bytes = b""
+
+        while start < end:
+            chunk = os.pread(fd, min(self.chunk_size, end - start), start)
+            if not chunk:
+                break
+
+            start += len(chunk)
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+
+            for line in lines:
+                self.row_id += 1
+                yield line.decode().rstrip().split(",")
+
+        if tail.strip():
+            self.row_id += 1
+            yield tail.decode().rstrip().split(",")
+
+
+_TRUE_VALUES = frozenset(("1", "true", "True", "TRUE"))
+_FALSE_VALUES = frozenset(("0", "false", "False", "FALSE"))
+
+
 def _is_true(s: str) -> bool:
     """Helper function to check if True."""
-    return s.lower() == "true" or s == "1"
+    # the lookup of common literals avoids allocating the lowercase copy of the string
+    if s in _TRUE_VALUES:
+        return True
+    if s in _FALSE_VALUES:
+        return False
+    return s.lower() == "true"
 
 
 class DataQualityError(Exception):
@@ -73,6 +208,27 @@ class DataQualityError(Exception):
     pass
 
 
+def _decode_uuid(s: str, column: str) -> UUID:
+    try:
+        return UUID(s)
+    except ValueError as e:
+        raise DataQualityError("failed to decode %s: %s" % (column, e.__str__()))
+
+
+def _decode_int(s: str, column: str) -> int:
+    try:
+        return int(s)
+    except ValueError as e:
+        raise DataQualityError("failed to decode %s: %s" % (column, e.__str__()))
+
+
+def _validate_date(s: str) -> None:
+    try:
+        _ = time.strptime(s, "%Y-%m-%d")
+    except ValueError as e:
+        raise DataQualityError("failed to decode date: %s" % e.__str__())
+
+
 def read_active_users(reader: CSVReader) -> set[UUID]:
     """Reads active users from the `users.csv`.
 
@@ -85,22 +241,35 @@ def read_active_users(reader: CSVReader) -> set[UUID]:
     Raises:
         DataQualityError: when data validation error happened.
     """
-    o: set[UUID] = set()
+    return set(iter_active_users(reader))
 
+
+def iter_active_users(reader: CSVReader) -> Iterator[UUID]:
+    """Streams active users from the `users.csv`.
+
+    Args:
+        reader (``CSVReader``): Initialised CSVReader object.
+
+    Returns:
+        Active user ID.
+
+    Raises:
+        DataQualityError: when data validation error happened.
+    """
     for cols in reader:
         if len(cols) < 2:
             raise DataQualityError("wrong number of columns in row %d" % reader.row_id)
 
         if _is_true(cols[1]):
             try:
-                o.add(UUID(cols[0]))
+                yield UUID(cols[0])
             except ValueError as e:
                 raise DataQualityError("failed to decode user_id in row %d: %s" % (reader.row_id, e.__str__()))
 
-    return o
-
 
 class Transaction:
+    __slots__ = ("transaction_id", "user_id", "transaction_amount", "transaction_category_id")
+
     def __init__(
         self, transaction_id: UUID, user_id: UUID, transaction_amount: int, transaction_category_id: int
     ) -> None:
@@ -151,35 +320,18 @@ def new_not_blocked_transaction(row: list[str]) -> Optional[Transaction]:
     if _is_true(row[3]):
         return None
 
-    try:
-        transaction_id = UUID(row[0])
-    except ValueError as e:
-        raise DataQualityError("failed to decode transaction_id: %s" % e.__str__())
-
-    try:
-        user_id = UUID(row[2])
-    except ValueError as e:
-        raise DataQualityError("failed to decode user_id: %s" % e.__str__())
-
-    try:
-        transaction_amount = int(row[4])
-    except ValueError as e:
-        raise DataQualityError("failed to decode transaction_amount: %s" % e.__str__())
-
-    try:
-        transaction_category_id = int(row[5])
-    except ValueError as e:
-        raise DataQualityError("failed to decode transaction_category_id: %s" % e.__str__())
-
-    try:
-        _ = time.strptime(row[1], "%Y-%m-%d")
-    except ValueError as e:
-        raise DataQualityError("failed to decode date: %s" % e.__str__())
+    transaction_id = _decode_uuid(row[0], "transaction_id")
+    user_id = _decode_uuid(row[2], "user_id")
+    transaction_amount = _decode_int(row[4], "transaction_amount")
+    transaction_category_id = _decode_int(row[5], "transaction_category_id")
+    _validate_date(row[1])
 
     return Transaction(transaction_id, user_id, transaction_amount, transaction_category_id)
 
 
 class TransactionCategoryKPI:
+    __slots__ = ("sum_amount", "num_users")
+
     def __init__(self, sum_amount: int, num_users: int):
         """Join output KPI.
 
@@ -200,6 +352,8 @@ class TransactionCategoryKPI:
 class TransactionCategoryKPICalc(TransactionCategoryKPI):
     """Defines the "container" for KPI fields calculation per transaction category."""
 
+    __slots__ = ("_unique_users",)
+
     def __init__(self, kpi: TransactionCategoryKPI = None) -> None:
         super().__init__(kpi.sum_amount, kpi.num_users) if kpi is not None else super().__init__(0, 0)
 
@@ -214,13 +368,114 @@ class TransactionCategoryKPICalc(TransactionCategoryKPI):
         self.sum_amount += transaction.transaction_amount
         self._unique_users.add(transaction.user_id)
 
-    def calculate(self):
+    def calculate(self) -> None:
         self.num_users = len(self._unique_users)
         del self._unique_users
 
+    def snapshot(self) -> "TransactionCategoryKPICalc":
+        """Calculates the KPI keeping the set of unique users, so more transactions can be added afterwards."""
+        return TransactionCategoryKPICalc(TransactionCategoryKPI(self.sum_amount, len(self._unique_users)))
+
+
+# Categories with ID in the range [0, _MAX_DENSE_CATEGORY_ID) are aggregated using the list lookup.
+_MAX_DENSE_CATEGORY_ID: int = 1024
+
+_T = TypeVar("_T")
+
 
 class QueryResult(dict[int, TransactionCategoryKPICalc]):
-    """Define the class to keep results of inner join."""
+    """Define the class to keep results of inner join.
+
+    The KPI accumulators are also kept in the list indexed by transaction_category_id, so aggregation of a row does not
+    allocate any objects. The list mirrors the dict, every change of the dict is applied to the list.
+    """
+
+    def __init__(self, kpis: Optional[dict[int, TransactionCategoryKPICalc]] = None) -> None:
+        super().__init__()
+        self._kpis: list[Optional[TransactionCategoryKPICalc]] = [None] * 16
+
+        if kpis is not None:
+            for transaction_category_id, kpi in kpis.items():
+                self[transaction_category_id] = kpi
+
+    def _index(self, transaction_category_id: int, kpi: Optional[TransactionCategoryKPICalc]) -> None:
+        if 0 <= transaction_category_id < _MAX_DENSE_CATEGORY_ID:
+            if transaction_category_id >= len(self._kpis):
+                if kpi is None:
+                    return
+                self._kpis.extend([None] * (transaction_category_id + 1 - len(self._kpis)))
+            self._kpis[transaction_category_id] = kpi
+
+    def __setitem__(self, transaction_category_id: int, kpi: TransactionCategoryKPICalc) -> None:
+        super().__setitem__(transaction_category_id, kpi)
+        self._index(transaction_category_id, kpi)
+
+    def __delitem__(self, transaction_category_id: int) -> None:
+        super().__delitem__(transaction_category_id)
+        self._index(transaction_category_id, None)
+
+    @overload
+    def pop(self, transaction_category_id: int, /) -> TransactionCategoryKPICalc:
+        ...
+
+    @overload
+    def pop(
+        self, transaction_category_id: int, default: Union[TransactionCategoryKPICalc, _T], /
+    ) -> Union[TransactionCategoryKPICalc, _T]:
+        ...
+
+    def pop(self, transaction_category_id: int, /, *default: object) -> object:
+        kpi: object = super().pop(transaction_category_id, *default)
+        self._index(transaction_category_id, None)
+        return kpi
+
+    def popitem(self) -> tuple[int, TransactionCategoryKPICalc]:
+        transaction_category_id, kpi = super().popitem()
+        self._index(transaction_category_id, None)
+        return transaction_category_id, kpi
+
+    def setdefault(self, transaction_category_id: int, kpi: TransactionCategoryKPICalc) -> TransactionCategoryKPICalc:
+        if transaction_category_id not in self:
+            self[transaction_category_id] = kpi
+        return self[transaction_category_id]
+
+    def update(self, *args: object, **kwargs: TransactionCategoryKPICalc) -> None:
+        super().update(*args, **kwargs)  # type: ignore[call-overload]
+
+        for transaction_category_id, kpi in self.items():
+            self._index(transaction_category_id, kpi)
+
+    def clear(self) -> None:
+        super().clear()
+        self._kpis = [None] * 16
+
+    def add(self, transaction_category_id: int, user_id: UUID, transaction_amount: int) -> None:
+        """Adds the transaction attributes.
+
+        Args:
+            transaction_category_id (int): Category.
+            user_id (UUID): User ID.
+            transaction_amount (int): Amount.
+        """
+        kpi: Optional[TransactionCategoryKPICalc] = None
+
+        if 0 <= transaction_category_id < len(self._kpis):
+            kpi = self._kpis[transaction_category_id]
+
+        if kpi is None:
+            kpi = self._new_kpi(transaction_category_id)
+
+        kpi.sum_amount += transaction_amount
+        kpi._unique_users.add(user_id)
+
+    def _new_kpi(self, transaction_category_id: int) -> TransactionCategoryKPICalc:
+        kpi: Optional[TransactionCategoryKPICalc] = self.get(transaction_category_id)
+
+        if kpi is None:
+            kpi = TransactionCategoryKPICalc()
+            self[transaction_category_id] = kpi
+
+        return kpi
 
     def add_transaction(self, transaction: Transaction) -> None:
         """Adds a transaction.
@@ -228,15 +483,38 @@ class QueryResult(dict[int, TransactionCategoryKPICalc]):
         Args:
             transaction (Transaction): Transaction object.
         """
-        kpi: TransactionCategoryKPICalc = self.get(transaction.transaction_category_id, TransactionCategoryKPICalc())
-        kpi.add_transaction(transaction)
-        self[transaction.transaction_category_id] = kpi
+        self.add(transaction.transaction_category_id, transaction.user_id, transaction.transaction_amount)
 
-    def calculate(self):
+    def calculate(self) -> None:
         """Calculates the results."""
         for v in self.values():
             v.calculate()
 
+    def merge(self, other: "QueryResult") -> None:
+        """Merges the results which are not calculated yet.
+
+        Args:
+            other (QueryResult): Results to merge into this one.
+        """
+        for k, v in other.items():
+            kpi: Optional[TransactionCategoryKPICalc] = self._kpis[k] if 0 <= k < len(self._kpis) else None
+
+            if kpi is None:
+                kpi = self._new_kpi(k)
+
+            kpi.sum_amount += v.sum_amount
+            kpi._unique_users.update(v._unique_users)
+
+    def snapshot(self) -> "QueryResult":
+        """Calculates the results keeping the state, so more transactions can be added afterwards.
+
+        Returns:
+            Calculated results sorted by transaction_amount.
+        """
+        o: QueryResult = QueryResult({k: v.snapshot() for k, v in self.items()})
+        o.sort_by_transactions_amount()
+        return o
+
     def sort_by_transactions_amount(self, desc: bool = True):
         """Sorts by transaction_amount.
 
@@ -273,71 +551,1666 @@ class QueryResult(dict[int, TransactionCategoryKPICalc]):
         return f"{header}\n{rows}\n"
 
 
-def main(path_users: str, path_transactions: str, skip_header: bool = True) -> Optional[QueryResult]:
-    """Entrypoint.
+def aggregate_transactions(result: QueryResult, reader: Iterable[list[str]], active_users: set[UUID]) -> QueryResult:
+    """Applies the filter and join conditions to the rows of `transactions.csv` and aggregates them.
+
+    Args:
+        result (QueryResult): Result to add the transactions to.
+        reader (Iterable[list[str]]): Parsed rows of the `transactions.csv` file.
+        active_users (set[UUID]): Set of active user ID.
+
+    Returns:
+        The result with the transactions added, it is not calculated yet.
+
+    Raises:
+        DataQualityError: when data validation error happened.
+    """
+    for row in reader:
+        aggregate_row(result, row, active_users)
+
+    return result
+
+
+def aggregate_row(result: QueryResult, row: list[str], active_users: set[UUID]) -> None:
+    """Applies the filter and join conditions to a single parsed row of `transactions.csv` and aggregates it.
+
+    Args:
+        result (QueryResult): Result to add the transaction to.
+        row (list): Parsed data row.
+        active_users (set[UUID]): Set of active user ID.
+
+    Raises:
+        DataQualityError: when data validation error happened.
+    """
+    if len(row) < 6:
+        raise DataQualityError("wrong number of columns")
+
+    if _is_true(row[3]):
+        return
+
+    # the row is decoded inline, the same way as by ``_decode_not_blocked_row``, to avoid the calls per column
+    column: str = "transaction_id"
+
+    try:
+        UUID(row[0])
+        column = "user_id"
+        user_id = UUID(row[2])
+        column = "transaction_amount"
+        transaction_amount = int(row[4])
+        column = "transaction_category_id"
+        transaction_category_id = int(row[5])
+        column = "date"
+        time.strptime(row[1], "%Y-%m-%d")
+    except ValueError as e:
+        raise DataQualityError("failed to decode %s: %s" % (column, e.__str__()))
+
+    # JOIN condition:
+    if user_id in active_users:
+        result.add(transaction_category_id, user_id, transaction_amount)
+
+
+def _decode_not_blocked_row(row: list[str]) -> Optional[tuple[UUID, int, int]]:
+    """Decodes a single non-blocked transaction from the parsed row of `transactions.csv` file.
+
+    The row is validated the same way as by ``new_not_blocked_transaction``, but no ``Transaction`` object is created.
+
+    Returns:
+        Tuple of user_id, transaction_amount and transaction_category_id, None if the transaction is blocked.
+
+    Raises:
+        DataQualityError: when data validation error happened.
+    """
+    if len(row) < 6:
+        raise DataQualityError("wrong number of columns")
+
+    if _is_true(row[3]):
+        return None
+
+    _decode_uuid(row[0], "transaction_id")
+    user_id = _decode_uuid(row[2], "user_id")
+    transaction_amount = _decode_int(row[4], "transaction_amount")
+    transaction_category_id = _decode_int(row[5], "transaction_category_id")
+    _validate_date(row[1])
+
+    return user_id, transaction_amount, transaction_category_id
+
+
+_SIDECAR_MAGIC: bytes = b"EX1SIDECAR\n"
+
+
+def _file_fingerprint(path: str, edge_size: int = 64 * 1024) -> list[int]:
+    """Fingerprints the file by its size, modification time, and checksum of its head and tail."""
+    stat = os.stat(path)
+
+    with open(path, "rb") as f:
+        checksum = zlib.crc32(f.read(edge_size))
+        if stat.st_size > edge_size:
+            f.seek(-edge_size, os.SEEK_END)
+            checksum = zlib.crc32(f.read(edge_size), checksum)
+
+    return [stat.st_size, stat.st_mtime_ns, checksum]
+
+
+def _write_sidecar(path: str, kind: str, path_data: str, arrays: list["array[int]"], **params: int) -> None:
+    """Writes the sidecar file with arrays describing the data file.
+
+    Format: the magic line, the JSON header line, and the binary dump of the arrays.
+    """
+    header = {
+        "kind": kind,
+        "fingerprint": _file_fingerprint(path_data),
+        "byteorder": sys.byteorder,
+        "params": params,
+        "arrays": [[a.typecode, len(a)] for a in arrays],
+    }
+
+    # the complete file replaces the previous one, so the interrupted write does not leave a partial sidecar
+    path_tmp = "%s.tmp" % path
+
+    with open(path_tmp, "wb") as f:
+        f.write(_SIDECAR_MAGIC)
+        f.write(json.dumps(header).encode() + b"\n")
+        for a in arrays:
+            a.tofile(f)
+
+    os.replace(path_tmp, path)
+
+
+def _read_sidecar(
+    path: str, kind: str, path_data: str, **params: int
+) -> Optional[tuple[dict[str, int], list["array[int]"]]]:
+    """Reads the sidecar file.
+
+    Args:
+        path (str): Path to the sidecar file.
+        kind (str): Expected kind of the sidecar.
+        path_data (str): Path to the data file described by the sidecar.
+        params (int): Expected parameters the sidecar was built with.
+
+    Returns:
+        Parameters and arrays, or None if the sidecar is missing, stale, or corrupted.
+    """
+    try:
+        with open(path, "rb") as f:
+            if f.readline() != _SIDECAR_MAGIC:
+                logs.warning("%s is not a sidecar file" % path)
+                return None
+
+            header = json.loads(f.readline())
+
+            if (
+                header["kind"] != kind
+                or header["fingerprint"] != _file_fingerprint(path_data)
+                or any(header["params"].get(k) != v for k, v in params.items())
+            ):
+                logs.warning("%s is stale, it does not match %s" % (path, path_data))
+                return None
+
+            arrays: list["array[int]"] = []
+            for typecode, length in header["arrays"]:
+                a = array(typecode)
+                a.fromfile(f, length)
+                if header["byteorder"] != sys.byteorder:
+                    a.byteswap()
+                arrays.append(a)
+
+            return header["params"], arrays
+    except FileNotFoundError:
+        logs.warning("%s not found" % path)
+        return None
+    except (ValueError, EOFError, KeyError, TypeError) as e:
+        logs.warning("%s is corrupted, it is ignored: %s" % (path, e.__str__()))
+        return None
+
+
+def build_row_index(path_transactions: str, path_index: str, skip_header: bool = True) -> int:
+    """Builds the sidecar index of non-blocked rows of the `transactions.csv` file.
+
+    The index stores the delta-encoded byte offsets of the rows, and the fingerprint of the file to detect its changes.
+    The malformed rows are indexed too, so the data validation errors are raised when reading through the index.
 
     Args:
-        path_users (str): Path to `users.csv` file.
         path_transactions (str): Path to `transactions.csv` file.
+        path_index (str): Path to the index file.
         skip_header (bool): Skip csv header.
 
     Returns:
-        Query results.
+        Number of indexed rows.
+    """
+    deltas: "array[int]" = array("Q")
+    offset: int = 0
+    offset_previous: int = 0
 
-    Note:
-        The logic is aiming to apply data transformations according to the query:
-            SELECT t.transaction_category_id,
-                   SUM(t.transaction_amount) AS sum_amount,
-                   COUNT(DISTINCT t.user_id) AS num_users
-            FROM transactions t
-                     JOIN users u USING (user_id)
-            WHERE t.is_blocked = False
-              AND u.is_active = 1
-            GROUP BY t.transaction_category_id
-            ORDER BY sum_amount DESC;
+    with open(path_transactions, "rb") as f:
+        if skip_header:
+            offset += len(f.readline())
+
+        for line in f:
+            cols = line.split(b",", 5)
+
+            if len(cols) < 6 or not _is_true(cols[3].decode()):
+                deltas.append(offset - offset_previous)
+                offset_previous = offset
+
+            offset += len(line)
+
+    if len(deltas) > 0 and max(deltas) < 2**32:
+        deltas = array("I", deltas)
+
+    _write_sidecar(path_index, "rows", path_transactions, [deltas], skip_header=int(skip_header))
+
+    return len(deltas)
+
+
+_DATE_MIN: int = date.min.toordinal()
+_DATE_MAX: int = date.max.toordinal()
+
+
+def _date_ordinal(s: str) -> int:
+    """Converts the date formatted as %Y-%m-%d to the proleptic Gregorian ordinal.
+
+    Raises:
+        ValueError: when the date cannot be decoded.
     """
-    active_users: set[UUID] = read_active_users(CSVReader(path_users, skip_header))
+    year, month, day = s.split("-")
+    return date(int(year), int(month), int(day)).toordinal()
 
-    if len(active_users) == 0:
-        return None
 
-    result: QueryResult = QueryResult()
+def build_zone_map(
+    path_transactions: str, path_zone_map: str, block_size: int = 1024 * 1024, skip_header: bool = True
+) -> int:
+    """Builds the zone map sidecar with the range of `date` values per block of the `transactions.csv` file.
 
-    for row in CSVReader(path_transactions, skip_header):
-        transaction: Optional[Transaction] = new_not_blocked_transaction(row)
+    A block consists of the rows which start within the same `block_size` bytes of the file. The block containing rows
+    which cannot be decoded spans the whole range of dates, so it is always read and validated.
 
-        if transaction is None:
-            continue
+    Args:
+        path_transactions (str): Path to `transactions.csv` file.
+        path_zone_map (str): Path to the zone map file.
+        block_size (int): Block size in bytes.
+        skip_header (bool): Skip csv header.
 
-        # JOIN condition:
-        if transaction.user_id not in active_users:
-            continue
+    Returns:
+        Number of blocks.
+    """
+    block_offsets: "array[int]" = array("Q")
+    block_min: "array[int]" = array("i")
+    block_max: "array[int]" = array("i")
 
-        result.add_transaction(transaction)
+    offset: int = 0
 
-    result.calculate()
-    result.sort_by_transactions_amount()
+    with open(path_transactions, "rb") as f:
+        if skip_header:
+            offset += len(f.readline())
 
-    return result
+        for line in f:
+            if len(block_offsets) == 0 or offset // block_size != block_offsets[-1] // block_size:
+                block_offsets.append(offset)
+                block_min.append(_DATE_MAX)
+                block_max.append(_DATE_MIN)
 
+            offset += len(line)
 
-if __name__ == "__main__":
-    base_dir = os.getenv("BASE_DIR", "/data")
-    path_users_csv = f"{base_dir}/users.csv"
-    path_transactions_csv = f"{base_dir}/transactions.csv"
+            if not line.strip():
+                continue
 
-    logging.basicConfig(
-        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%dT%H:%M:%S.%03d"
+            cols = line.split(b",", 2)
+
+            try:
+                value = _date_ordinal(cols[1].decode())
+            except (IndexError, ValueError):
+                block_min[-1], block_max[-1] = _DATE_MIN, _DATE_MAX
+                continue
+
+            if value < block_min[-1]:
+                block_min[-1] = value
+            if value > block_max[-1]:
+                block_max[-1] = value
+
+    _write_sidecar(
+        path_zone_map,
+        "zone_map",
+        path_transactions,
+        [block_offsets, block_min, block_max],
+        block_size=block_size,
+        skip_header=int(skip_header),
     )
 
-    logs = logging.getLogger("joiner")
+    return len(block_offsets)
 
-    try:
-        t0 = time.time()
-        results = main(path_users_csv, path_transactions_csv, True)
-        logs.info("elapsed time: %.0f microseconds" % ((time.time() - t0) * 1_000_000))
-        logging.shutdown()
 
-        print(results)
+def _prune_blocks(
+    zone_map: list["array[int]"], size: int, date_from: Optional[date], date_to: Optional[date]
+) -> list[tuple[int, int]]:
+    """Selects byte ranges of the blocks which may contain rows within the date range, adjacent blocks are merged."""
+    block_offsets, block_min, block_max = zone_map
+    value_from = date_from.toordinal() if date_from is not None else _DATE_MIN
+    value_to = date_to.toordinal() if date_to is not None else _DATE_MAX
+
+    o: list[tuple[int, int]] = []
+    cnt: int = 0
+
+    for i, start in enumerate(block_offsets):
+        if block_max[i] < value_from or block_min[i] > value_to:
+            continue
+
+        cnt += 1
+        end = block_offsets[i + 1] if i + 1 < len(block_offsets) else size
+
+        if len(o) > 0 and o[-1][1] == start:
+            o[-1] = (o[-1][0], end)
+        else:
+            o.append((start, end))
+
+    logs.info("zone map: %d of %d blocks to be read" % (cnt, len(block_offsets)))
+
+    return o
+
+
+def _filter_offsets(offsets: Iterable[int], ranges: list[tuple[int, int]]) -> Iterator[int]:
+    """Filters the sorted offsets falling within the sorted byte ranges."""
+    i = 0
+
+    for offset in offsets:
+        while i < len(ranges) and ranges[i][1] <= offset:
+            i += 1
+
+        if i == len(ranges):
+            return
+
+        if offset >= ranges[i][0]:
+            yield offset
+
+
+def _filter_dates(
+    reader: Iterable[list[str]], date_from: Optional[date], date_to: Optional[date]
+) -> Iterator[list[str]]:
+    """Filters the non-blocked rows by the `date` column, the rows which cannot be decoded are passed to be validated.
+
+    The blocked rows are dropped without validation, the same way as by ``aggregate_row``; the non-blocked rows out of
+    the range are validated before they are dropped.
+
+    Raises:
+        DataQualityError: when a non-blocked row out of the range is invalid.
+    """
+    date_from = date_from if date_from is not None else date.min
+    date_to = date_to if date_to is not None else date.max
+    iso_from, iso_to = date_from.isoformat(), date_to.isoformat()
+    value_from, value_to = date_from.toordinal(), date_to.toordinal()
+
+    for row in reader:
+        if len(row) < 6:
+            yield row
+            continue
+
+        if _is_true(row[3]):
+            continue
+
+        value = row[1]
+
+        # zero padded dates are compared as strings, others have to be decoded
+        if len(value) == 10:
+            is_within_range = iso_from <= value <= iso_to
+        else:
+            try:
+                is_within_range = value_from <= _date_ordinal(value) <= value_to
+            except ValueError:
+                is_within_range = True
+
+        if is_within_range:
+            yield row
+        else:
+            _decode_not_blocked_row(row)
+
+
+def _transactions_reader(
+    path_transactions: str,
+    skip_header: bool = True,
+    path_index: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    path_zone_map: Optional[str] = None,
+) -> Iterable[list[str]]:
+    """Defines the reader of `transactions.csv`.
+
+    The sidecar index, and the zone map are used if they are set and up-to-date.
+    """
+    ranges: Optional[list[tuple[int, int]]] = None
+    reader: Optional[Iterable[list[str]]] = None
+
+    if path_zone_map is not None and (date_from is not None or date_to is not None):
+        sidecar = _read_sidecar(path_zone_map, "zone_map", path_transactions, skip_header=int(skip_header))
+
+        if sidecar is not None:
+            ranges = _prune_blocks(sidecar[1], os.path.getsize(path_transactions), date_from, date_to)
+        else:
+            logs.warning("reading all blocks of %s" % path_transactions)
+
+    if path_index is not None:
+        sidecar = _read_sidecar(path_index, "rows", path_transactions, skip_header=int(skip_header))
+
+        if sidecar is not None:
+            offsets: Iterable[int] = accumulate(sidecar[1][0])
+            reader = IndexedReader(path_transactions, offsets if ranges is None else _filter_offsets(offsets, ranges))
+        else:
+            logs.warning("falling back to the full scan of %s" % path_transactions)
+
+    if reader is None:
+        reader = (
+            RangeReader(path_transactions, ranges) if ranges is not None else CSVReader(path_transactions, skip_header)
+        )
+
+    if date_from is not None or date_to is not None:
+        reader = _filter_dates(reader, date_from, date_to)
+
+    return reader
+
+
+PLAN_AUTO: str = "auto"
+PLAN_BUILD_USERS: str = "build_users"
+PLAN_BUILD_TRANSACTIONS: str = "build_transactions"
+
+# Relative memory cost of a build side entry: a user ID in the set, and a user ID mapped to the sums per category.
+_BUILD_USERS_COST: int = 1
+_BUILD_TRANSACTIONS_COST: int = 2
+
+
+def estimate_rows(
+    path: str,
+    predicate: Callable[[list[str]], bool],
+    skip_header: bool = True,
+    num_blocks: int = 8,
+    block_size: int = 64 * 1024,
+) -> int:
+    """Estimates the number of rows of the csv file satisfying the predicate.
+
+    The rows are sampled from evenly spaced blocks, the file is read in full if it's smaller than the sample.
+
+    Args:
+        path (str): Path to the csv file.
+        predicate (Callable): Function to filter the parsed rows.
+        skip_header (bool): Skip csv header.
+        num_blocks (int): Number of sampled blocks.
+        block_size (int): Size of the sampled block in bytes.
+
+    Returns:
+        Estimated number of rows.
+    """
+    size: int = os.path.getsize(path)
+    size_sampled: int = 0
+    cnt: int = 0
+
+    with open(path, "rb") as f:
+        start = len(f.readline()) if skip_header else 0
+
+        if size - start <= num_blocks * block_size:
+            num_blocks, block_size = 1, size - start
+
+        for i in range(num_blocks):
+            offset = start + (size - start - block_size) * i // max(num_blocks - 1, 1)
+            f.seek(offset)
+
+            if offset > start:
+                # the block starts in the middle of a row
+                offset += len(f.readline())
+
+            end = offset + block_size
+
+            while offset < end:
+                line = f.readline()
+                if not line:
+                    break
+
+                offset += len(line)
+                size_sampled += len(line)
+
+                if predicate(line.decode().rstrip().split(",")):
+                    cnt += 1
+
+    if size_sampled == 0:
+        return 0
+
+    return cnt * (size - start) // size_sampled
+
+
+def _is_active_user_row(row: list[str]) -> bool:
+    return len(row) > 1 and _is_true(row[1])
+
+
+def _is_not_blocked_row(row: list[str]) -> bool:
+    return len(row) > 3 and not _is_true(row[3])
+
+
+def plan_join(path_users: str, path_transactions: str, skip_header: bool = True) -> str:
+    """Selects the build side of the hash join by the estimated cardinality of both sides.
+
+    Args:
+        path_users (str): Path to `users.csv` file.
+        path_transactions (str): Path to `transactions.csv` file.
+        skip_header (bool): Skip csv header.
+
+    Returns:
+        PLAN_BUILD_USERS, or PLAN_BUILD_TRANSACTIONS.
+    """
+    try:
+        num_users = estimate_rows(path_users, _is_active_user_row, skip_header)
+        num_transactions = estimate_rows(path_transactions, _is_not_blocked_row, skip_header)
+    except OSError as e:
+        logs.info("join plan: %s, no statistics available: %s" % (PLAN_BUILD_USERS, e.__str__()))
+        return PLAN_BUILD_USERS
+
+    plan = (
+        PLAN_BUILD_TRANSACTIONS
+        if num_transactions * _BUILD_TRANSACTIONS_COST < num_users * _BUILD_USERS_COST
+        else PLAN_BUILD_USERS
+    )
+
+    logs.info(
+        "join plan: %s, estimated ~%d active users, ~%d non-blocked transactions" % (plan, num_users, num_transactions)
+    )
+
+    return plan
+
+
+def join_build_transactions(users: Iterable[UUID], reader: Iterable[list[str]]) -> Optional[QueryResult]:
+    """Joins the transactions to users building the hash map from the non-blocked transactions.
+
+    The amounts are summed up per user and category, the active users are streamed to probe the map.
+
+    Args:
+        users (Iterable[UUID]): Active user ID.
+        reader (Iterable[list[str]]): Parsed rows of the `transactions.csv` file.
+
+    Returns:
+        Query results which are not calculated yet, None if there are no active users.
+
+    Raises:
+        DataQualityError: when data validation error happened.
+    """
+    users = iter(users)
+    first_user: Optional[UUID] = next(users, None)
+
+    # the transactions are not read, nor validated if there are no active users
+    if first_user is None:
+        return None
+
+    transactions: dict[UUID, dict[int, int]] = {}
+
+    for row in reader:
+        fields = _decode_not_blocked_row(row)
+
+        if fields is None:
+            continue
+
+        user_id, transaction_amount, transaction_category_id = fields
+        amounts = transactions.setdefault(user_id, {})
+        amounts[transaction_category_id] = amounts.get(transaction_category_id, 0) + transaction_amount
+
+    result: QueryResult = QueryResult()
+
+    for user_id in chain((first_user,), users):
+        # JOIN condition, every user is matched once:
+        for transaction_category_id, transaction_amount in transactions.pop(user_id, {}).items():
+            result.add(transaction_category_id, user_id, transaction_amount)
+
+    return result
+
+
+ENGINE_PYTHON: str = "python"
+ENGINE_SQLITE: str = "sqlite"
+
+_SQLITE_SCHEMA: tuple[str, ...] = (
+    "DROP TABLE IF EXISTS transactions",
+    "DROP TABLE IF EXISTS users",
+    """CREATE TABLE transactions (
+        transaction_id          TEXT,
+        date                    TEXT,
+        user_id                 BLOB,
+        is_blocked              INTEGER,
+        transaction_amount      INTEGER,
+        transaction_category_id INTEGER
+    )""",
+    """CREATE TABLE users (
+        user_id   BLOB,
+        is_active INTEGER
+    )""",
+)
+
+_SQLITE_QUERY: str = """
+SELECT t.transaction_category_id,
+       SUM(t.transaction_amount) AS sum_amount,
+       COUNT(DISTINCT t.user_id) AS num_users
+FROM transactions t
+JOIN users u USING (user_id)
+WHERE NOT t.is_blocked
+  AND u.is_active{conditions}
+GROUP BY t.transaction_category_id
+ORDER BY sum_amount DESC
+"""
+
+
+def _sqlite_users(reader: CSVReader) -> Iterator[tuple[bytes, int]]:
+    """Validates the rows the same way as ``iter_active_users``, the inactive users are not validated, nor loaded."""
+    for user_id in iter_active_users(reader):
+        yield user_id.bytes, 1
+
+
+def _sqlite_load(con: sqlite3.Connection, table: str, rows: Iterator[tuple[object, ...]], batch_size: int) -> None:
+    """Inserts the rows in batches, each batch is inserted within a single transaction."""
+    placeholders: str = ""
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if len(batch) == 0:
+            break
+
+        placeholders = placeholders or ",".join("?" * len(batch[0]))
+
+        with con:
+            con.executemany(f"INSERT INTO {table} VALUES ({placeholders})", batch)
+
+    _stage(f"load_{table}")
+
+
+def _sqlite_transactions(reader: CSVReader) -> Iterator[tuple[str, str, bytes, int, int, int]]:
+    """Validates the rows the same way as ``aggregate_row``, the blocked rows are neither validated, nor loaded.
+
+    The dates which are not zero padded are normalised, so they can be compared as strings.
+    """
+    for row in reader:
+        if len(row) < 6:
+            raise DataQualityError("wrong number of columns in row %d" % reader.row_id)
+
+        if _is_true(row[3]):
+            continue
+
+        _decode_uuid(row[0], "transaction_id")
+        user_id = _decode_uuid(row[2], "user_id")
+        transaction_amount = _decode_int(row[4], "transaction_amount")
+        transaction_category_id = _decode_int(row[5], "transaction_category_id")
+        _validate_date(row[1])
+
+        yield (
+            row[0],
+            row[1] if len(row[1]) == 10 else date.fromordinal(_date_ordinal(row[1])).isoformat(),
+            user_id.bytes,
+            0,
+            transaction_amount,
+            transaction_category_id,
+        )
+
+
+def main_sqlite(
+    path_users: str,
+    path_transactions: str,
+    skip_header: bool = True,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    path_db: str = ":memory:",
+    batch_size: int = 100_000,
+    cache_size: int = 256 * 1024,
+    mmap_size: int = 1024**3,
+) -> Optional[QueryResult]:
+    """Runs the query with sqlite3.
+
+    The tables are bulk-loaded in batches, each batch is inserted within a single transaction. The journal and
+    synchronisation are disabled because the database is disposable.
+
+    Args:
+        path_users (str): Path to `users.csv` file.
+        path_transactions (str): Path to `transactions.csv` file.
+        skip_header (bool): Skip csv header.
+        date_from (date): Filter transactions made on, or after the date.
+        date_to (date): Filter transactions made on, or before the date.
+        path_db (str): Path to the database file, the tables are dropped and loaded again. The database is kept in
+            memory by default, the file allows to process data which do not fit in memory.
+        batch_size (int): Number of rows inserted in a single transaction.
+        cache_size (int): Page cache size in KiB.
+        mmap_size (int): Maximum number of bytes of the database file to access with memory-mapped I/O.
+
+    Returns:
+        Query results.
+
+    Raises:
+        DataQualityError: when data validation error happened.
+    """
+    con = sqlite3.connect(path_db)
+
+    try:
+        for pragma in (
+            "journal_mode = OFF",
+            "synchronous = OFF",
+            "locking_mode = EXCLUSIVE",
+            "temp_store = MEMORY",
+            "cache_size = -%d" % cache_size,
+            "mmap_size = %d" % mmap_size,
+        ):
+            con.execute(f"PRAGMA {pragma}")
+
+        for statement in _SQLITE_SCHEMA:
+            con.execute(statement)
+
+        _sqlite_load(con, "users", _sqlite_users(CSVReader(path_users, skip_header)), batch_size)
+
+        # the transactions are not loaded, nor validated if there are no active users, the same way as by ``main``
+        if con.execute("SELECT 1 FROM users WHERE is_active LIMIT 1").fetchone() is None:
+            return None
+
+        con.execute("CREATE INDEX users_user_id ON users (user_id)")
+
+        _sqlite_load(con, "transactions", _sqlite_transactions(CSVReader(path_transactions, skip_header)), batch_size)
+
+        conditions: str = ""
+        parameters: tuple[str, ...] = ()
+
+        if date_from is not None or date_to is not None:
+            conditions = "\n  AND t.date BETWEEN ? AND ?"
+            parameters = ((date_from or date.min).isoformat(), (date_to or date.max).isoformat())
+
+        cursor = con.execute(_SQLITE_QUERY.format(conditions=conditions), parameters)
+
+        result: QueryResult = QueryResult(
+            {
+                transaction_category_id: TransactionCategoryKPICalc(TransactionCategoryKPI(sum_amount, num_users))
+                for transaction_category_id, sum_amount, num_users in cursor
+            }
+        )
+        _stage("query")
+
+        return result
+    finally:
+        con.close()
+
+
+def main(
+    path_users: str,
+    path_transactions: str,
+    skip_header: bool = True,
+    path_index: Optional[str] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    path_zone_map: Optional[str] = None,
+    plan: str = PLAN_AUTO,
+    engine: str = ENGINE_PYTHON,
+    path_db: str = ":memory:",
+) -> Optional[QueryResult]:
+    """Entrypoint.
+
+    Args:
+        path_users (str): Path to `users.csv` file.
+        path_transactions (str): Path to `transactions.csv` file.
+        skip_header (bool): Skip csv header.
+        path_index (str): Path to the sidecar index of non-blocked rows built by ``build_row_index``.
+        date_from (date): Filter transactions made on, or after the date.
+        date_to (date): Filter transactions made on, or before the date.
+        path_zone_map (str): Path to the zone map built by ``build_zone_map`` to skip blocks beyond the dates range.
+        plan (str): Build side of the join: PLAN_BUILD_USERS, PLAN_BUILD_TRANSACTIONS, or PLAN_AUTO to select it by
+            the estimated cardinality of both sides. The cardinality of transactions is estimated for the whole file,
+            so PLAN_AUTO selects PLAN_BUILD_USERS without the estimation if the dates range is set.
+        engine (str): ENGINE_PYTHON, or ENGINE_SQLITE to run the query with ``main_sqlite``, the sidecar files, and
+            the join plan are not used by sqlite.
+        path_db (str): Path to the sqlite database file.
+
+    Returns:
+        Query results.
+
+    Note:
+        The logic is aiming to apply data transformations according to the query:
+            SELECT t.transaction_category_id,
+                   SUM(t.transaction_amount) AS sum_amount,
+                   COUNT(DISTINCT t.user_id) AS num_users
+            FROM transactions t
+                     JOIN users u USING (user_id)
+            WHERE t.is_blocked = False
+              AND u.is_active = 1
+            GROUP BY t.transaction_category_id
+            ORDER BY sum_amount DESC;
+
+        The dates range adds the condition `t.date BETWEEN date_from AND date_to`.
+    """
+    if engine == ENGINE_SQLITE:
+        return main_sqlite(path_users, path_transactions, skip_header, date_from, date_to, path_db)
+
+    if plan == PLAN_AUTO:
+        if date_from is not None or date_to is not None:
+            plan = PLAN_BUILD_USERS
+            logs.info("join plan: %s, the dates range is set" % plan)
+        else:
+            plan = plan_join(path_users, path_transactions, skip_header)
+
+    reader: Iterable[list[str]] = _transactions_reader(
+        path_transactions, skip_header, path_index, date_from, date_to, path_zone_map
+    )
+
+    result: Optional[QueryResult] = None
+
+    if plan == PLAN_BUILD_TRANSACTIONS:
+        result = join_build_transactions(iter_active_users(CSVReader(path_users, skip_header)), reader)
+        _stage("join")
+    else:
+        active_users: set[UUID] = read_active_users(CSVReader(path_users, skip_header))
+        _stage("read_active_users")
+
+        if len(active_users) > 0:
+            result = aggregate_transactions(QueryResult(), reader, active_users)
+            _stage("join")
+
+    if result is None:
+        return None
+
+    result.calculate()
+    result.sort_by_transactions_amount()
+    _stage("calculate")
+
+    return result
+
+
+_PARTIAL_MAGIC: bytes = b"EX1PARTIAL\n"
+_PARTIAL_CATEGORY = struct.Struct("<qqQ")
+
+
+def write_partial(result: QueryResult, path: str) -> None:
+    """Writes the results which are not calculated yet to the binary file, so they can be merged by ``read_partial``.
+
+    Format: the magic line, and the sequence of categories. Each category is encoded as transaction_category_id,
+    sum_amount, number of unique users, followed by the packed 16 bytes user ID.
+
+    Args:
+        result (QueryResult): Results which are not calculated yet.
+        path (str): Path to the output file.
+    """
+    with open(path, "wb") as f:
+        f.write(_PARTIAL_MAGIC)
+
+        for k, v in result.items():
+            f.write(_PARTIAL_CATEGORY.pack(k, v.sum_amount, len(v._unique_users)))
+            f.write(b"".join(user_id.bytes for user_id in v._unique_users))
+
+
+def read_partial(path: str) -> QueryResult:
+    """Reads the results written by ``write_partial``.
+
+    Args:
+        path (str): Path to the partial results file.
+
+    Returns:
+        Results which are not calculated yet.
+
+    Raises:
+        DataQualityError: when the file is not valid.
+    """
+    o: QueryResult = QueryResult()
+
+    with open(path, "rb") as f:
+        if f.read(len(_PARTIAL_MAGIC)) != _PARTIAL_MAGIC:
+            raise DataQualityError("%s is not a partial results file" % path)
+
+        while True:
+            header = f.read(_PARTIAL_CATEGORY.size)
+
+            if not header:
+                break
+
+            if len(header) != _PARTIAL_CATEGORY.size:
+                raise DataQualityError("%s is truncated" % path)
+
+            transaction_category_id, sum_amount, num_users = _PARTIAL_CATEGORY.unpack(header)
+            user_ids = f.read(16 * num_users)
+
+            if len(user_ids) != 16 * num_users:
+                raise DataQualityError("%s is truncated" % path)
+
+            kpi = o._new_kpi(transaction_category_id)
+            kpi.sum_amount += sum_amount
+            kpi._unique_users.update(UUID(bytes=user_id) for (user_id,) in struct.iter_unpack("16s", user_ids))
+
+    return o
+
+
+def map_partial(path_users: str, path_transactions: str, path_partial: str, skip_header: bool = True) -> QueryResult:
+    """Runs the filter, join and aggregation over a partition of transactions, and writes the partial results.
+
+    Args:
+        path_users (str): Path to `users.csv` file.
+        path_transactions (str): Path to `transactions.csv` file with a partition of transactions.
+        path_partial (str): Path to the output partial results file.
+        skip_header (bool): Skip csv header.
+
+    Returns:
+        Results which are not calculated yet.
+    """
+    active_users: set[UUID] = read_active_users(CSVReader(path_users, skip_header))
+
+    result: QueryResult = QueryResult()
+
+    if len(active_users) > 0:
+        aggregate_transactions(result, _transactions_reader(path_transactions, skip_header), active_users)
+
+    write_partial(result, path_partial)
+
+    return result
+
+
+def reduce_partials(paths_partial: list[str], path_partial: Optional[str] = None) -> QueryResult:
+    """Merges the partial results.
+
+    Args:
+        paths_partial (list[str]): Paths to the partial results files.
+        path_partial (str): Path to write the merged partial results to, so they can be merged further.
+
+    Returns:
+        Query results, they are calculated and sorted unless written as the partial results.
+    """
+    result: QueryResult = QueryResult()
+
+    for path in paths_partial:
+        result.merge(read_partial(path))
+
+    if path_partial is not None:
+        write_partial(result, path_partial)
+        return result
+
+    result.calculate()
+    result.sort_by_transactions_amount()
+
+    return result
+
+
+class CategoryEstimate(TransactionCategoryKPICalc):
+    """Defines the KPI estimated from the sample with the confidence interval of the total transactions amount."""
+
+    __slots__ = ("sum_amount_low", "sum_amount_high")
+
+    def __init__(self, sum_amount: int, sum_amount_low: int, sum_amount_high: int, num_users: int) -> None:
+        super().__init__(TransactionCategoryKPI(sum_amount, num_users))
+        self.sum_amount_low = sum_amount_low
+        self.sum_amount_high = sum_amount_high
+
+
+class PreviewResult(QueryResult):
+    """Define the class to keep results estimated from the sample."""
+
+    def __str__(self) -> str:
+        header: str = "transaction_category_id,sum_amount,sum_amount_low,sum_amount_high,num_users"
+        rows: str = "\n".join(
+            [
+                f"{k},{v.sum_amount},{v.sum_amount_low},{v.sum_amount_high},{v.num_users}"
+                for k, v in self.items()
+                if isinstance(v, CategoryEstimate)
+            ]
+        )
+        return f"{header}\n{rows}\n"
+
+
+def _next_row_start(fd: int, offset: int, size: int) -> int:
+    """Finds the start of the first row beginning at, or after the offset."""
+    if offset == 0:
+        return offset
+
+    position = offset - 1
+
+    while position < size:
+        chunk = os.pread(fd, 4096, position)
+        if not chunk:
+            break
+
+        i = chunk.find(b"\n")
+        if i != -1:
+            return position + i + 1
+
+        position += len(chunk)
+
+    return size
+
+
+def t_quantile(p: float, df: int) -> float:
+    """Calculates the quantile of Student's t-distribution.
+
+    The quantile is exact for one and two degrees of freedom, and approximated by its asymptotic expansion in terms of
+    the normal quantile for more (Abramowitz and Stegun, 26.7.5), the error is below 0.5% for three degrees of freedom,
+    and it decreases with more.
+
+    Args:
+        p (float): Probability, between 0 and 1.
+        df (int): Number of degrees of freedom, at least one.
+
+    Returns:
+        Quantile.
+    """
+    if df == 1:
+        return math.tan(math.pi * (p - 0.5))
+
+    if df == 2:
+        return (2 * p - 1) / math.sqrt(2 * p * (1 - p))
+
+    z = NormalDist().inv_cdf(p)
+    g1 = (z**3 + z) / 4
+    g2 = (5 * z**5 + 16 * z**3 + 3 * z) / 96
+    g3 = (3 * z**7 + 19 * z**5 + 17 * z**3 - 15 * z) / 384
+    g4 = (79 * z**9 + 776 * z**7 + 1482 * z**5 - 1920 * z**3 - 945 * z) / 92160
+
+    return z + g1 / df + g2 / df**2 + g3 / df**3 + g4 / df**4
+
+
+def estimate_distinct(frequencies: Iterable[int], sample_fraction: float) -> int:
+    """Estimates the number of distinct values in the population from their frequencies in the sample.
+
+    The Shlosser estimator (Haas et al., 1995): the number of values seen in the sample is extrapolated by the share of
+    values seen only once, so it scales up with the sample for unique values, and converges to it for repeated ones.
+
+    Args:
+        frequencies (Iterable[int]): Number of sampling units each distinct value was seen in.
+        sample_fraction (float): Share of the population sampling units in the sample.
+
+    Returns:
+        Estimated number of distinct values.
+    """
+    counts: dict[int, int] = {}
+    for frequency in frequencies:
+        counts[frequency] = counts.get(frequency, 0) + 1
+
+    num_distinct: int = sum(counts.values())
+
+    if sample_fraction >= 1 or 1 not in counts:
+        return num_distinct
+
+    q = sample_fraction
+    numerator = sum((1 - q) ** i * f for i, f in counts.items())
+    denominator = sum(i * q * (1 - q) ** (i - 1) * f for i, f in counts.items())
+
+    return round(num_distinct + counts[1] * numerator / denominator)
+
+
+def preview(
+    path_users: str,
+    path_transactions: str,
+    skip_header: bool = True,
+    sample_fraction: float = 0.01,
+    time_budget: float = 2.0,
+    block_size: int = 256 * 1024,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+) -> Optional[PreviewResult]:
+    """Estimates the query results from the random sample of blocks of `transactions.csv`.
+
+    The sampled blocks are aligned to rows, and processed by the same filter and join logic. The total amount is
+    extrapolated by the number of blocks with the confidence interval based on the variance between the blocks, the
+    number of unique users is estimated with ``estimate_distinct`` capped by the number of active users.
+
+    The interval uses the quantile of Student's t-distribution with n-1 degrees of freedom for n sampled blocks,
+    because a few blocks are sampled by default. It assumes the block sums are close to normal, so the actual coverage
+    is lower for a few blocks: 92% for the nominal 95% with 4 blocks of 1M generated transactions.
+
+    Args:
+        path_users (str): Path to `users.csv` file.
+        path_transactions (str): Path to `transactions.csv` file.
+        skip_header (bool): Skip csv header.
+        sample_fraction (float): Fraction of blocks to sample.
+        time_budget (float): Stop sampling after the given number of seconds, at least two blocks are sampled.
+        block_size (int): Size of the sampled block in bytes.
+        confidence (float): Confidence level of the interval of the total amount.
+        seed (int): Random seed.
+
+    Returns:
+        Estimated query results.
+    """
+    t0: float = time.monotonic()
+
+    active_users: set[UUID] = read_active_users(CSVReader(path_users, skip_header))
+
+    if len(active_users) == 0:
+        return None
+
+    with open(path_transactions, "rb") as f:
+        start: int = len(f.readline()) if skip_header else 0
+
+    size: int = os.path.getsize(path_transactions)
+    num_blocks: int = max(math.ceil((size - start) / block_size), 1)
+
+    # two blocks at least are sampled to estimate the variance
+    num_sampled: int = min(max(math.ceil(num_blocks * sample_fraction), 2), num_blocks)
+    blocks: list[int] = random.Random(seed).sample(range(num_blocks), num_sampled)
+
+    block_sums: list[dict[int, int]] = []
+    user_frequencies: dict[int, dict[UUID, int]] = {}
+
+    fd = os.open(path_transactions, os.O_RDONLY)
+
+    try:
+        for block in blocks:
+            if len(block_sums) > 1 and time.monotonic() - t0 > time_budget:
+                break
+
+            block_start = start + block * block_size
+            block_end = min(block_start + block_size, size)
+            row_range = (_next_row_start(fd, block_start, size), _next_row_start(fd, block_end, size))
+
+            result = aggregate_transactions(QueryResult(), RangeReader(path_transactions, [row_range]), active_users)
+
+            block_sums.append({k: v.sum_amount for k, v in result.items()})
+
+            for k, v in result.items():
+                frequencies = user_frequencies.setdefault(k, {})
+                for user_id in v._unique_users:
+                    frequencies[user_id] = frequencies.get(user_id, 0) + 1
+    finally:
+        os.close(fd)
+
+    n: int = len(block_sums)
+
+    logs.info(
+        "preview: sampled %d of %d blocks (%.2f%%) in %.3f sec."
+        % (n, num_blocks, n / num_blocks * 100, time.monotonic() - t0)
+    )
+
+    o: PreviewResult = PreviewResult()
+    t: float = t_quantile((1 + confidence) / 2, n - 1) if n > 1 else 0.0
+
+    for k, frequencies in user_frequencies.items():
+        values = [sums.get(k, 0) for sums in block_sums]
+        mean = sum(values) / n
+        variance = sum((value - mean) ** 2 for value in values) / (n - 1) if n > 1 else 0.0
+        error = t * num_blocks * math.sqrt((1 - n / num_blocks) * variance / n)
+
+        o[k] = CategoryEstimate(
+            round(num_blocks * mean),
+            max(round(num_blocks * mean - error), 0),
+            round(num_blocks * mean + error),
+            min(estimate_distinct(frequencies.values(), n / num_blocks), len(active_users)),
+        )
+
+    o.sort_by_transactions_amount()
+
+    return o
+
+
+class FileFollower:
+    """Follows the growing csv file like `tail -F`.
+
+    Only complete lines are parsed. The file is reopened when it gets rotated, i.e. replaced by a new file under the
+    same path, or read from the start when it gets truncated.
+    """
+
+    def __init__(self, path: str, skip_header: bool = True, poll_interval: float = 1.0) -> None:
+        self.path = path
+        self.skip_header = skip_header
+        self.poll_interval = poll_interval
+        self.row_id = -1
+        self._file_io: Optional[BinaryIO] = None
+        self._inode: int = -1
+        self._partial: bytes = b""
+        self._header_skipped = not skip_header
+
+    def __iter__(self) -> "FileFollower":
+        return self
+
+    def __next__(self) -> Optional[list[str]]:
+        """Returns the next parsed row, or None if no new complete line was written during the poll interval."""
+        while True:
+            if self._file_io is None:
+                self._open()
+
+            if self._file_io is None:
+                time.sleep(self.poll_interval)
+                return None
+
+            chunk = self._file_io.readline()
+
+            if chunk.endswith(b"\n"):
+                line, self._partial = self._partial + chunk, b""
+            elif chunk:
+                self._partial += chunk
+                continue
+            elif self._is_rotated(self._file_io):
+                # the rotated file won't be appended anymore, hence its last line is complete
+                line, self._partial = self._partial, b""
+                self.close()
+                if not line:
+                    continue
+            else:
+                time.sleep(self.poll_interval)
+                return None
+
+            self.row_id += 1
+
+            if not self._header_skipped:
+                self._header_skipped = True
+                continue
+
+            text = line.decode().rstrip()
+            if text:
+                return text.split(",")
+
+    def _open(self) -> None:
+        try:
+            self._file_io = open(self.path, "rb")
+        except FileNotFoundError:
+            return
+
+        self._inode = os.fstat(self._file_io.fileno()).st_ino
+        self._header_skipped = not self.skip_header
+        self.row_id = -1
+
+    def _is_rotated(self, file_io: BinaryIO) -> bool:
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # the file was moved, but the new one has not been created yet
+            return False
+
+        if stat.st_ino != self._inode:
+            logs.info("%s was rotated, reopening" % self.path)
+            return True
+
+        if stat.st_size < file_io.tell():
+            logs.info("%s was truncated, reading from the start" % self.path)
+            file_io.seek(0)
+            self._partial = b""
+            self._header_skipped = not self.skip_header
+            self.row_id = -1
+
+        return False
+
+    def close(self) -> None:
+        """Closes the followed file."""
+        if self._file_io is not None:
+            self._file_io.close()
+            self._file_io = None
+
+
+def follow(
+    path_users: str,
+    path_transactions: str,
+    skip_header: bool = True,
+    snapshot_interval: float = 60.0,
+    snapshot_rows: int = 0,
+    poll_interval: float = 1.0,
+    emit: Callable[[QueryResult], None] = print,
+    max_snapshots: Optional[int] = None,
+) -> Optional[QueryResult]:
+    """Follows the growing `transactions.csv` file and emits the query results incrementally.
+
+    Args:
+        path_users (str): Path to `users.csv` file.
+        path_transactions (str): Path to `transactions.csv` file.
+        skip_header (bool): Skip csv header.
+        snapshot_interval (float): Emit the results every given number of seconds, disabled if not positive.
+        snapshot_rows (int): Emit the results every given number of read rows, disabled if not positive.
+        poll_interval (float): Time in seconds to wait for new lines to be appended.
+        emit (Callable): Function to output the results snapshot.
+        max_snapshots (int): Stop after the given number of snapshots, never stops if not set.
+
+    Returns:
+        The last emitted snapshot of the query results.
+    """
+    active_users: set[UUID] = read_active_users(CSVReader(path_users, skip_header))
+
+    if len(active_users) == 0:
+        return None
+
+    result: QueryResult = QueryResult()
+    snapshot: QueryResult = QueryResult()
+    cnt_snapshots: int = 0
+    cnt_rows: int = 0
+    t0: float = time.monotonic()
+
+    follower = FileFollower(path_transactions, skip_header, poll_interval)
+
+    try:
+        for row in follower:
+            if row is not None:
+                aggregate_row(result, row, active_users)
+                cnt_rows += 1
+
+            if (snapshot_rows > 0 and cnt_rows >= snapshot_rows) or (
+                snapshot_interval > 0 and time.monotonic() - t0 >= snapshot_interval
+            ):
+                snapshot = result.snapshot()
+                emit(snapshot)
+
+                cnt_snapshots += 1
+                cnt_rows = 0
+                t0 = time.monotonic()
+
+                if max_snapshots is not None and cnt_snapshots >= max_snapshots:
+                    break
+    finally:
+        follower.close()
+
+    return snapshot
+
+
+class ActiveUsersIndex:
+    """Keeps the set of active users in memory and reloads it when `users.csv` changes."""
+
+    def __init__(self, path: str, skip_header: bool = True) -> None:
+        self.path = path
+        self.skip_header = skip_header
+        self.active_users: set[UUID] = set()
+        self._fingerprint: Optional[tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+
+    def get(self) -> set[UUID]:
+        """Returns the set of active users, `users.csv` is re-read only if it changed since the previous call.
+
+        Raises:
+            DataQualityError: when data validation error happened.
+        """
+        stat = os.stat(self.path)
+        fingerprint = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+        with self._lock:
+            if fingerprint != self._fingerprint:
+                self.active_users = read_active_users(CSVReader(self.path, self.skip_header))
+                self._fingerprint = fingerprint
+                logs.info("loaded %d active users from %s" % (len(self.active_users), self.path))
+
+            return self.active_users
+
+
+class QueryServer:
+    """Serves the query results over a stream socket.
+
+    The protocol is newline-delimited JSON. A request names one, or more `transactions.csv` files which are treated as
+    partitions of the same table:
+        {"transactions": ["/data/transactions.csv"]}
+
+    The response is either the query result in the csv format, or the error message:
+        {"result": "transaction_category_id,sum_amount,num_users\n..."}
+        {"error": "..."}
+
+    The requests are processed by a pool of threads sharing the in-memory index. The query is CPU bound pure python,
+    so the concurrent requests are interleaved by the GIL rather than run in parallel: the pool keeps slow requests
+    from blocking the event loop and lets I/O waits overlap, it does not add CPU throughput.
+    """
+
+    def __init__(self, index: ActiveUsersIndex, max_workers: Optional[int] = None) -> None:
+        self.index = index
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def query(self, paths_transactions: list[str]) -> Optional[QueryResult]:
+        """Runs the query against the given transactions files.
+
+        Args:
+            paths_transactions (list[str]): Paths to `transactions.csv` files.
+
+        Returns:
+            Query results.
+        """
+        active_users: set[UUID] = self.index.get()
+
+        if len(active_users) == 0:
+            return None
+
+        result: QueryResult = QueryResult()
+
+        for path in paths_transactions:
+            aggregate_transactions(result, CSVReader(path, self.index.skip_header), active_users)
+
+        result.calculate()
+        result.sort_by_transactions_amount()
+
+        return result
+
+    async def _respond(self, line: bytes) -> dict[str, Optional[str]]:
+        try:
+            request = json.loads(line)
+            paths = request.get("transactions") if isinstance(request, dict) else None
+
+            if not isinstance(paths, list) or len(paths) == 0 or not all(isinstance(path, str) for path in paths):
+                raise ValueError("request must contain the non-empty list of paths under the 'transactions' key")
+
+            result = await asyncio.get_running_loop().run_in_executor(self._executor, self.query, paths)
+        except (ValueError, OSError, DataQualityError) as e:
+            return {"error": e.__str__()}
+
+        return {"result": result.__str__() if result is not None else None}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Handles the client connection, a single connection may send several requests."""
+        try:
+            while True:
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                if not line.strip():
+                    continue
+
+                writer.write(json.dumps(await self._respond(line)).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    def shutdown(self) -> None:
+        """Stops the worker pool."""
+        self._executor.shutdown(wait=True)
+
+
+async def serve(
+    index: ActiveUsersIndex, socket_path: Optional[str] = None, port: int = 8000, max_workers: Optional[int] = None
+) -> None:
+    """Runs the query daemon.
+
+    Args:
+        index (ActiveUsersIndex): Index of active users.
+        socket_path (str): Path to the unix socket, the localhost TCP port is used if not set.
+        port (int): Localhost TCP port.
+        max_workers (int): Number of workers to process the requests concurrently.
+    """
+    index.get()
+
+    app = QueryServer(index, max_workers)
+
+    if socket_path is not None:
+        server = await asyncio.start_unix_server(app.handle, path=socket_path)
+        logs.info("listening on %s" % socket_path)
+    else:
+        server = await asyncio.start_server(app.handle, host="127.0.0.1", port=port)
+        logs.info("listening on 127.0.0.1:%d" % port)
+
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        app.shutdown()
+
+
+class SamplingProfiler:
+    """Samples the call stack on the CPU time timer signal, and writes the stacks in the collapsed format.
+
+    The output is the input of flamegraph tools, e.g. https://github.com/brendangregg/FlameGraph, or speedscope.
+    Only the main thread is sampled.
+    """
+
+    def __init__(self, path: str, interval: float = 0.005) -> None:
+        self.path = path
+        self.interval = interval
+        self.samples: dict[str, int] = {}
+        self._previous_handler: Union[Callable[[int, Optional[FrameType]], object], int, None] = None
+
+    def _sample(self, signum: int, frame: Optional[FrameType]) -> None:
+        stack: list[str] = []
+
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+
+        key = ";".join(reversed(stack))
+        self.samples[key] = self.samples.get(key, 0) + 1
+
+    def start(self) -> None:
+        """Starts sampling."""
+        if tracemalloc.is_tracing():
+            logs.warning("the stack samples are distorted by the tracemalloc allocation hooks, profile them separately")
+
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self) -> None:
+        """Stops sampling, and writes the collapsed stacks."""
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        # the handler which was not installed from Python is reported as None
+        signal.signal(signal.SIGPROF, self._previous_handler if self._previous_handler is not None else signal.SIG_DFL)
+        self._previous_handler = None
+
+        with open(self.path, "w") as f:
+            for stack, cnt in sorted(self.samples.items()):
+                f.write(f"{stack} {cnt}\n")
+
+        logs.info("%d stack samples written to %s" % (sum(self.samples.values()), self.path))
+
+    def __enter__(self) -> "SamplingProfiler":
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+
+class AllocationTracer:
+    """Traces memory allocations with tracemalloc, and takes snapshots at the query stage boundaries.
+
+    The snapshots are dumped to the directory, they can be loaded with ``tracemalloc.Snapshot.load``. The top
+    allocation differences against the previous stage are logged.
+    """
+
+    def __init__(self, directory: str, nframes: int = 1, top: int = 5) -> None:
+        self.directory = directory
+        self.nframes = nframes
+        self.top = top
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._cnt: int = 0
+
+    def mark(self, stage: str) -> None:
+        """Takes the snapshot at the end of the stage."""
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+
+        self._cnt += 1
+        path = os.path.join(self.directory, "%02d_%s.tracemalloc" % (self._cnt, stage))
+        snapshot.dump(path)
+
+        logs.info("stage %s: %d bytes traced, %d bytes peak, snapshot %s" % (stage, current, peak, path))
+
+        stats = (
+            snapshot.compare_to(self._snapshot, "lineno")
+            if self._snapshot is not None
+            else snapshot.statistics("lineno")
+        )
+
+        for stat in stats[: self.top]:
+            logs.info("stage %s: %s" % (stage, stat))
+
+        self._snapshot = snapshot
+
+    def start(self) -> None:
+        """Starts tracing."""
+        os.makedirs(self.directory, exist_ok=True)
+        tracemalloc.start(self.nframes)
+        _stage_hooks.append(self.mark)
+
+    def stop(self) -> None:
+        """Stops tracing."""
+        _stage_hooks.remove(self.mark)
+        tracemalloc.stop()
+
+    def __enter__(self) -> "AllocationTracer":
+        self.start()
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    base_dir = os.getenv("BASE_DIR", "/data")
+    path_users_csv = f"{base_dir}/users.csv"
+    path_transactions_csv = f"{base_dir}/transactions.csv"
+    path_index = f"{path_transactions_csv}.idx"
+    path_zone_map = f"{path_transactions_csv}.zonemap"
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--follow", action="store_true", help="follow the growing transactions.csv like tail -F")
+    parser.add_argument("--snapshot-interval", type=float, default=60.0, help="follow mode: emit results every N sec.")
+    parser.add_argument("--snapshot-rows", type=int, default=0, help="follow mode: emit results every N read rows")
+    parser.add_argument("--use-index", action="store_true", help="read non-blocked rows only using the sidecar index")
+    parser.add_argument("--date-from", type=date.fromisoformat, default=None, help="filter dates from YYYY-MM-DD")
+    parser.add_argument("--date-to", type=date.fromisoformat, default=None, help="filter dates to YYYY-MM-DD")
+    parser.add_argument("--use-zone-map", action="store_true", help="skip blocks beyond the dates using the zone map")
+    parser.add_argument(
+        "--plan",
+        choices=(PLAN_AUTO, PLAN_BUILD_USERS, PLAN_BUILD_TRANSACTIONS),
+        default=PLAN_AUTO,
+        help="build side of the join",
+    )
+    parser.add_argument("--engine", choices=(ENGINE_PYTHON, ENGINE_SQLITE), default=ENGINE_PYTHON, help="query engine")
+    parser.add_argument("--sqlite-db", default=":memory:", help="sqlite engine: path to the database file")
+    parser.add_argument(
+        "--profile-samples",
+        default=os.getenv("PROFILE_SAMPLES"),
+        help="write sampled call stacks in the collapsed format to the path, env: PROFILE_SAMPLES",
+    )
+    parser.add_argument(
+        "--profile-interval",
+        type=float,
+        default=float(os.getenv("PROFILE_INTERVAL", "0.005")),
+        help="stack sampling interval in seconds of CPU time, env: PROFILE_INTERVAL",
+    )
+    parser.add_argument(
+        "--profile-tracemalloc",
+        default=os.getenv("PROFILE_TRACEMALLOC"),
+        help="dump tracemalloc snapshots at the query stages to the directory, env: PROFILE_TRACEMALLOC",
+    )
+    commands = parser.add_subparsers(dest="command")
+
+    parser_serve = commands.add_parser("serve", help="runs the query daemon keeping active users in memory")
+    parser_serve.add_argument("--socket", default=None, help="path to the unix socket to listen on")
+    parser_serve.add_argument("--port", type=int, default=8000, help="localhost TCP port used if no socket is set")
+    parser_serve.add_argument("--workers", type=int, default=None, help="number of concurrent query workers")
+
+    commands.add_parser("index", help="builds the sidecar index of non-blocked rows of transactions.csv")
+
+    parser_zone_map = commands.add_parser("zonemap", help="builds the zone map of dates per block of transactions.csv")
+    parser_zone_map.add_argument("--block-size", type=int, default=1024 * 1024, help="block size in bytes")
+
+    parser_map = commands.add_parser("map", help="aggregates a partition of transactions to the partial results file")
+    parser_map.add_argument("--transactions", default=path_transactions_csv, help="path to the transactions partition")
+    parser_map.add_argument("--output", required=True, help="path to the partial results file")
+
+    parser_reduce = commands.add_parser("reduce", help="merges the partial results files and prints the results")
+    parser_reduce.add_argument("partials", nargs="+", help="paths to the partial results files")
+    parser_reduce.add_argument("--output", default=None, help="write the merged partial results file instead")
+
+    parser_preview = commands.add_parser("preview", help="estimates the results from a random sample of blocks")
+    parser_preview.add_argument("--fraction", type=float, default=0.01, help="fraction of blocks to sample")
+    parser_preview.add_argument("--time-budget", type=float, default=2.0, help="max sampling time in seconds")
+    parser_preview.add_argument("--seed", type=int, default=None, help="random seed")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s", datefmt="%Y-%m-%dT%H:%M:%S.%03d"
+    )
+
+    profiling = ExitStack()
+
+    if args.profile_tracemalloc:
+        profiling.enter_context(AllocationTracer(args.profile_tracemalloc))
+
+    if args.profile_samples:
+        profiling.enter_context(SamplingProfiler(args.profile_samples, args.profile_interval))
+
+    try:
+        if args.command == "serve":
+            asyncio.run(serve(ActiveUsersIndex(path_users_csv), args.socket, args.port, args.workers))
+        elif args.command == "index":
+            cnt = build_row_index(path_transactions_csv, path_index, True)
+            logs.info("indexed %d non-blocked rows to %s" % (cnt, path_index))
+        elif args.command == "zonemap":
+            cnt = build_zone_map(path_transactions_csv, path_zone_map, args.block_size, True)
+            logs.info("mapped %d blocks to %s" % (cnt, path_zone_map))
+        elif args.command == "map":
+            map_partial(path_users_csv, args.transactions, args.output, True)
+            logs.info("partial results written to %s" % args.output)
+        elif args.command == "reduce":
+            merged = reduce_partials(args.partials, args.output)
+            if args.output is None:
+                print(merged)
+        elif args.command == "preview":
+            print(preview(path_users_csv, path_transactions_csv, True, args.fraction, args.time_budget, seed=args.seed))
+        elif args.follow:
+            follow(
+                path_users_csv,
+                path_transactions_csv,
+                True,
+                args.snapshot_interval,
+                args.snapshot_rows,
+                emit=lambda snapshot: print(snapshot, flush=True),
+            )
+        else:
+            t0 = time.time()
+            results = main(
+                path_users_csv,
+                path_transactions_csv,
+                True,
+                path_index if args.use_index else None,
+                args.date_from,
+                args.date_to,
+                path_zone_map if args.use_zone_map else None,
+                args.plan,
+                args.engine,
+                args.sqlite_db,
+            )
+            logs.info("elapsed time: %.0f microseconds" % ((time.time() - t0) * 1_000_000))
+            logging.shutdown()
+
+            print(results)
+    except KeyboardInterrupt:
+        pass
     except Exception as ex:
         logs.error(ex)
+    finally:
+        profiling.close()
@@ -18,8 +18,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import asyncio
+import json
 import os
+import random
+import signal
 import sys
+import time
+from datetime import date
 from io import StringIO
 from typing import Optional
 from uuid import UUID, uuid4
@@ -28,15 +34,39 @@ import pytest
 from mock_open import MockOpen  # type: ignore
 
 from main import (
+    ENGINE_PYTHON,
+    ENGINE_SQLITE,
+    PLAN_BUILD_TRANSACTIONS,
+    PLAN_BUILD_USERS,
+    ActiveUsersIndex,
+    AllocationTracer,
     CSVReader,
     DataQualityError,
+    FileFollower,
+    IndexedReader,
     QueryResult,
+    QueryServer,
+    RangeReader,
+    SamplingProfiler,
     Transaction,
     TransactionCategoryKPI,
     TransactionCategoryKPICalc,
+    aggregate_row,
+    build_row_index,
+    build_zone_map,
+    estimate_distinct,
+    estimate_rows,
+    follow,
     main,
+    main_sqlite,
+    map_partial,
     new_not_blocked_transaction,
+    plan_join,
+    preview,
     read_active_users,
+    read_partial,
+    reduce_partials,
+    t_quantile,
 )
 
 
@@ -327,3 +357,739 @@ def test_data_quality():
             print(result)
 
         assert "\n".join(stdout) == want
+
+
+USERS_CSV = """user_id,is_active
+9f709688-326d-4834-8075-1a477d590af7,1
+999eb541-c1a0-4888-aeb6-92773fc60e69,0
+b1ee6da9-aca5-4bc6-bcfb-21ace2185055,true
+"""
+
+TRANSACTIONS_CSV = """transaction_id,date,user_id,is_blocked,transaction_amount,transaction_category_id
+ce861100-26f0-4f1a-a8e3-8d6b3ad7a0e8,2022-01-01,9f709688-326d-4834-8075-1a477d590af7,1,100,1
+3e6cdc49-f1c5-4ac6-9483-37622eed207a,2022-01-01,9f709688-326d-4834-8075-1a477d590af7,0,200,1
+5c2e5c85-75e1-4137-bf13-529a000757f6,2022-02-01,999eb541-c1a0-4888-aeb6-92773fc60e69,false,100,1
+35715617-ea5d-4c00-842a-0aa81b224934,2022-02-02,b1ee6da9-aca5-4bc6-bcfb-21ace2185055,false,200,1
+ca0d184e-7297-4ac2-95a6-6ed719a67b0a,2022-02-02,b1ee6da9-aca5-4bc6-bcfb-21ace2185055,false,20,2
+"""
+
+
+def test_ActiveUsersIndex(tmp_path):
+    # GIVEN users.csv with two active users
+    path = tmp_path / "users.csv"
+    path.write_text(USERS_CSV)
+
+    index = ActiveUsersIndex(str(path))
+
+    # WHEN the index is read twice without changes
+    got = index.get()
+
+    # THEN the same set is served without re-reading the file
+    assert got == {UUID("9f709688-326d-4834-8075-1a477d590af7"), UUID("b1ee6da9-aca5-4bc6-bcfb-21ace2185055")}
+    assert index.get() is got
+
+    # WHEN the file changes
+    path.write_text(
+        USERS_CSV.replace("9f709688-326d-4834-8075-1a477d590af7,1", "9f709688-326d-4834-8075-1a477d590af7,false")
+    )
+
+    # THEN the index is reloaded
+    assert index.get() == {UUID("b1ee6da9-aca5-4bc6-bcfb-21ace2185055")}
+
+
+def test_QueryServer(tmp_path):
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    socket_path = str(tmp_path / "joiner.sock")
+    app = QueryServer(ActiveUsersIndex(str(tmp_path / "users.csv")), max_workers=2)
+
+    async def request(lines: list[str]) -> list[dict]:
+        server = await asyncio.start_unix_server(app.handle, path=socket_path)
+        async with server:
+            reader, writer = await asyncio.open_unix_connection(socket_path)
+            writer.write("".join(f"{line}\n" for line in lines).encode())
+            await writer.drain()
+            o = [json.loads(await reader.readline()) for _ in lines]
+            writer.close()
+        return o
+
+    # WHEN two requests are sent over the same connection
+    got = asyncio.run(
+        request(
+            [
+                json.dumps({"transactions": [str(tmp_path / "transactions.csv")] * 2}),
+                json.dumps({"files": []}),
+            ]
+        )
+    )
+    app.shutdown()
+
+    # THEN the partitions are aggregated together
+    assert got[0] == {"result": "transaction_category_id,sum_amount,num_users\n1,800,2\n2,40,1\n"}
+
+    # AND the faulty request yields the error
+    assert "error" in got[1]
+
+
+def test_FileFollower(tmp_path):
+    path = tmp_path / "transactions.csv"
+    path.write_text("foo,bar\n1,a\n2,")
+
+    follower = FileFollower(str(path), skip_header=True, poll_interval=0)
+
+    # WHEN the last line is incomplete
+    # THEN only the complete lines are read
+    assert next(follower) == ["1", "a"]
+    assert next(follower) is None
+
+    # WHEN the line is completed
+    with open(path, "a") as f:
+        f.write("b\n")
+
+    assert next(follower) == ["2", "b"]
+    assert next(follower) is None
+
+    # WHEN the file is rotated
+    path.rename(tmp_path / "transactions.csv.1")
+    assert next(follower) is None
+
+    path.write_text("foo,bar\n3,c\n")
+
+    # THEN the new file is read from the start skipping the header
+    assert next(follower) == ["3", "c"]
+    assert next(follower) is None
+
+    # WHEN the file is truncated
+    path.write_text("foo,bar\n")
+    assert next(follower) is None
+
+    with open(path, "a") as f:
+        f.write("4,d\n")
+
+    # THEN it is read from the start
+    assert next(follower) == ["4", "d"]
+
+    follower.close()
+
+
+def test_follow(tmp_path):
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    snapshots: list[str] = []
+
+    # WHEN the results are emitted every 2 rows
+    got = follow(
+        str(tmp_path / "users.csv"),
+        str(tmp_path / "transactions.csv"),
+        snapshot_interval=0,
+        snapshot_rows=2,
+        poll_interval=0,
+        emit=lambda result: snapshots.append(result.__str__()),
+        max_snapshots=2,
+    )
+
+    # THEN the distinct users state is kept between the snapshots
+    assert snapshots == [
+        "transaction_category_id,sum_amount,num_users\n1,200,1\n",
+        "transaction_category_id,sum_amount,num_users\n1,400,2\n",
+    ]
+    assert got.__str__() == snapshots[-1]
+
+
+def test_QueryResult_add():
+    uid = uuid4()
+
+    # GIVEN categories within and outside the range of the list lookup
+    categories = (1, 1, 0, -1, 5000, 20)
+
+    # WHEN the rows are added without creating the transaction objects
+    result = QueryResult()
+    for i, category in enumerate(categories):
+        result.add(category, uid, i + 1)
+
+    # AND the same rows are added as transactions to the result with preset category
+    want = QueryResult({1: TransactionCategoryKPICalc()})
+    for i, category in enumerate(categories):
+        want.add_transaction(Transaction(uuid4(), uid, i + 1, category))
+
+    # THEN the results match
+    assert {k: v.sum_amount for k, v in result.items()} == {1: 3, 0: 3, -1: 4, 5000: 5, 20: 6}
+    assert {k: v.sum_amount for k, v in want.items()} == {k: v.sum_amount for k, v in result.items()}
+    assert want[1] is want._kpis[1], "the list lookup must refer to the dict values"
+
+
+def test_QueryResult_mutations():
+    uid = uuid4()
+    result = QueryResult()
+    result.add(1, uid, 1)
+    result.add(2, uid, 1)
+
+    # WHEN the accumulators are replaced, and removed from the dict
+    result[1] = TransactionCategoryKPICalc()
+    del result[2]
+    result.add(1, uid, 10)
+    result.add(2, uid, 20)
+
+    # THEN the rows added afterwards update the accumulators kept by the dict
+    assert {k: v.sum_amount for k, v in result.items()} == {1: 10, 2: 20}
+
+    popped = result.pop(2)
+    result.popitem()
+    result.add(2, uid, 5)
+
+    assert popped.sum_amount == 20
+    assert {k: v.sum_amount for k, v in result.items()} == {2: 5}
+
+    result.update({2: TransactionCategoryKPICalc()})
+    result.add(2, uid, 1)
+
+    assert result[2] is result._kpis[2]
+    assert result[2].sum_amount == 1
+
+
+def test_aggregate_row():
+    active_users = {UUID("9f709688-326d-4834-8075-1a477d590af7")}
+    result = QueryResult()
+
+    rows = [line.split(",") for line in TRANSACTIONS_CSV.splitlines()[1:]]
+    for row in rows:
+        aggregate_row(result, row, active_users)
+
+    result.calculate()
+    assert result.__str__() == "transaction_category_id,sum_amount,num_users\n1,200,1\n"
+
+    with pytest.raises(DataQualityError, match="failed to decode transaction_amount"):
+        aggregate_row(result, rows[1][:4] + ["foo"] + rows[1][5:], active_users)
+
+
+@pytest.mark.parametrize("max_gap", [0, 4, 4096])
+def test_IndexedReader(tmp_path, max_gap):
+    path = tmp_path / "foo.csv"
+    long_value = "x" * 1000
+    path.write_text(f"foo,bar\n1,a\n2,{long_value}\n3,c\r\n4,d")
+
+    reader = IndexedReader(str(path), [8, 12, 1015, 1020], max_gap)
+
+    assert list(reader) == [["1", "a"], ["2", long_value], ["3", "c"], ["4", "d"]]
+
+
+@pytest.mark.parametrize("max_gap,want", [(0, 20 * 256), (4096, 2 * (9 * 1000 + 256))])
+def test_IndexedReader_bytes_read(tmp_path, mocker, max_gap, want):
+    # GIVEN the rows of 10 bytes, and the offsets of 10 rows 1000 bytes apart in two groups
+    path = tmp_path / "foo.csv"
+    path.write_text("".join("%09d\n" % i for i in range(20_000)))
+
+    offsets = [i * 1000 for i in range(10)] + [100_000 + i * 1000 for i in range(10)]
+
+    bytes_read: list[int] = []
+    pread = os.pread
+
+    def pread_counted(fd: int, length: int, offset: int) -> bytes:
+        o = pread(fd, length, offset)
+        bytes_read.append(len(o))
+        return o
+
+    mocker.patch("os.pread", pread_counted)
+
+    # WHEN the rows are read
+    reader = IndexedReader(str(path), offsets, max_gap)
+    assert [int(row[0]) for row in reader] == [offset // 10 for offset in offsets]
+
+    # THEN only the short reads of the rows, and the gaps up to max_gap are read
+    assert sum(bytes_read) == want
+
+
+def test_main_with_row_index(tmp_path):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+    path_index = str(tmp_path / "transactions.csv.idx")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # WHEN the index is built
+    # THEN only the non-blocked rows are indexed
+    assert build_row_index(path_transactions, path_index) == 4
+
+    # AND the results using the index match the full scan
+    want = main(path_users, path_transactions).__str__()
+    assert main(path_users, path_transactions, path_index=path_index).__str__() == want
+
+    # WHEN the transactions file changes
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace(",0,200,1", ",1,200,1"))
+
+    # THEN the stale index is ignored
+    assert (
+        main(path_users, path_transactions, path_index=path_index).__str__()
+        == main(path_users, path_transactions).__str__()
+    )
+
+
+@pytest.mark.parametrize("size", [0, 5, 20, -1])
+def test_main_with_row_index_corrupted(tmp_path, size):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+    path_index = tmp_path / "transactions.csv.idx"
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # GIVEN the index which was written partially
+    build_row_index(path_transactions, str(path_index))
+    assert not (tmp_path / "transactions.csv.idx.tmp").exists()
+
+    content = path_index.read_bytes()
+    path_index.write_bytes(content[:size] if size >= 0 else content[: content.index(b"\n", 11) + 3])
+
+    # THEN the index is ignored
+    assert (
+        main(path_users, path_transactions, path_index=str(path_index)).__str__()
+        == main(path_users, path_transactions).__str__()
+    )
+
+
+def test_main_with_row_index_malformed_row(tmp_path):
+    # GIVEN a blocked row with the missing column
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+    path_index = str(tmp_path / "transactions.csv.idx")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace(",1,100,1", ",1,100"))
+
+    # WHEN the index is built
+    # THEN the malformed row is indexed
+    assert build_row_index(path_transactions, path_index) == 5
+
+    # AND the query using the index fails the same way as the full scan
+    with pytest.raises(DataQualityError, match="wrong number of columns"):
+        main(path_users, path_transactions)
+
+    with pytest.raises(DataQualityError, match="wrong number of columns"):
+        main(path_users, path_transactions, path_index=path_index)
+
+
+def test_RangeReader(tmp_path):
+    path = tmp_path / "foo.csv"
+    path.write_text("foo,bar\n1,a\n2,b\r\n3,c\n4,d")
+
+    reader = RangeReader(str(path), [(8, 12), (17, 26)], chunk_size=3)
+
+    assert list(reader) == [["1", "a"], ["3", "c"], ["4", "d"]]
+
+
+@pytest.mark.parametrize(
+    "date_from,date_to,want",
+    [
+        (None, None, "1,400,2\n2,20,1\n"),
+        (date(2022, 2, 1), None, "1,200,1\n2,20,1\n"),
+        (None, date(2022, 1, 31), "1,200,1\n"),
+        (date(2022, 3, 1), None, "\n"),
+    ],
+)
+def test_main_with_zone_map(tmp_path, date_from, date_to, want):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+    path_zone_map = str(tmp_path / "transactions.csv.zonemap")
+    path_index = str(tmp_path / "transactions.csv.idx")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace("2022-02-02", "2022-2-2"))
+
+    # GIVEN the zone map with a row per block
+    assert build_zone_map(path_transactions, path_zone_map, block_size=64) == 5
+    build_row_index(path_transactions, path_index)
+
+    want = "transaction_category_id,sum_amount,num_users\n" + want
+
+    # THEN the dates filter yields the same results with, and without the sidecar files
+    assert main(path_users, path_transactions, date_from=date_from, date_to=date_to).__str__() == want
+    assert (
+        main(path_users, path_transactions, date_from=date_from, date_to=date_to, path_zone_map=path_zone_map).__str__()
+        == want
+    )
+    assert (
+        main(
+            path_users,
+            path_transactions,
+            path_index=path_index,
+            date_from=date_from,
+            date_to=date_to,
+            path_zone_map=path_zone_map,
+        ).__str__()
+        == want
+    )
+
+
+@pytest.mark.parametrize("value", ["2022-13-01", "2022-02-30"])
+def test_main_with_dates_filter_invalid_date(tmp_path, value):
+    # GIVEN an invalid date out of the dates range
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace("2022-02-01", value))
+
+    # WHEN the query is run with the dates filter
+    # THEN the row fails the validation instead of being dropped
+    with pytest.raises(DataQualityError, match="failed to decode date"):
+        main(path_users, path_transactions, date_to=date(2022, 1, 31))
+
+
+def test_main_with_dates_filter_invalid_blocked_row(tmp_path):
+    # GIVEN an invalid blocked row out of the dates range
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(
+        TRANSACTIONS_CSV.replace("ce861100-26f0-4f1a-a8e3-8d6b3ad7a0e8,2022-01-01", "foo,2022-13-01")
+    )
+
+    # THEN both engines skip the row
+    for engine in (ENGINE_PYTHON, ENGINE_SQLITE):
+        assert main(path_users, path_transactions, date_to=date(2022, 1, 31), engine=engine).__str__() == (
+            "transaction_category_id,sum_amount,num_users\n1,200,1\n"
+        )
+
+
+def test_map_reduce(tmp_path):
+    path_users = str(tmp_path / "users.csv")
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # GIVEN the transactions split into three partitions
+    header, *rows = TRANSACTIONS_CSV.splitlines()
+    for i in range(3):
+        (tmp_path / f"transactions_{i}.csv").write_text("\n".join([header] + rows[i::3]) + "\n")
+
+    # WHEN every partition is mapped
+    partials = [str(tmp_path / f"partial_{i}.bin") for i in range(3)]
+    for i, path in enumerate(partials):
+        map_partial(path_users, str(tmp_path / f"transactions_{i}.csv"), path)
+
+    # AND the partials are reduced in a tree
+    reduce_partials(partials[:2], str(tmp_path / "partial_01.bin"))
+    got = reduce_partials([str(tmp_path / "partial_01.bin"), partials[2]])
+
+    # THEN the results match the results over the whole table
+    assert got.__str__() == main(path_users, str(tmp_path / "transactions.csv")).__str__()
+
+    # AND the state of unique users is preserved in the partial file
+    assert read_partial(str(tmp_path / "partial_01.bin"))[1]._unique_users == {
+        UUID("9f709688-326d-4834-8075-1a477d590af7"),
+        UUID("b1ee6da9-aca5-4bc6-bcfb-21ace2185055"),
+    }
+
+    # WHEN the file is not the partial results
+    # THEN the error is raised
+    with pytest.raises(DataQualityError):
+        read_partial(path_users)
+
+
+def test_estimate_rows(tmp_path):
+    path = tmp_path / "users.csv"
+    path.write_text("user_id,is_active\n" + "".join(f"{uuid4()},{i % 4 == 0}\n" for i in range(4000)))
+
+    # WHEN the file is smaller than the sample
+    # THEN the estimate is exact
+    assert estimate_rows(str(path), lambda row: row[1] == "True") == 1000
+
+    # WHEN the file is sampled
+    got = estimate_rows(str(path), lambda row: row[1] == "True", num_blocks=4, block_size=1024)
+
+    # THEN the estimate is close
+    assert 900 < got < 1100
+
+
+def test_plan_join(tmp_path):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV + "".join(f"{uuid4()},1\n" for _ in range(10)))
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # WHEN there are fewer non-blocked transactions than active users
+    # THEN the transactions are the build side
+    assert plan_join(path_users, path_transactions) == PLAN_BUILD_TRANSACTIONS
+
+    # WHEN the statistics are not available
+    # THEN the users are the build side
+    assert plan_join(str(tmp_path / "foo.csv"), path_transactions) == PLAN_BUILD_USERS
+
+    # AND both plans yield the same results
+    assert (
+        main(path_users, path_transactions, plan=PLAN_BUILD_TRANSACTIONS).__str__()
+        == main(path_users, path_transactions, plan=PLAN_BUILD_USERS).__str__()
+        == "transaction_category_id,sum_amount,num_users\n1,400,2\n2,20,1\n"
+    )
+
+
+def test_main_plan_with_dates_range(tmp_path, mocker):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    plan = mocker.patch("main.plan_join", return_value=PLAN_BUILD_TRANSACTIONS)
+
+    # WHEN the dates range is set
+    got = main(path_users, path_transactions, date_from=date(2022, 2, 1))
+
+    # THEN the cardinality of the whole file is not estimated
+    plan.assert_not_called()
+    assert got.__str__() == "transaction_category_id,sum_amount,num_users\n1,200,1\n2,20,1\n"
+
+
+@pytest.mark.parametrize(
+    "frequencies,sample_fraction,want",
+    [
+        ([1, 1, 1, 1], 0.5, 8),
+        ([3, 2, 4], 0.1, 3),
+        ([1, 1, 2], 1.0, 3),
+    ],
+)
+def test_estimate_distinct(frequencies, sample_fraction, want):
+    assert estimate_distinct(frequencies, sample_fraction) == want
+
+
+def test_preview(tmp_path):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # WHEN all blocks are sampled
+    got = preview(path_users, path_transactions, sample_fraction=1.0, block_size=100, seed=0)
+
+    # THEN the estimate is exact
+    assert got.__str__() == (
+        "transaction_category_id,sum_amount,sum_amount_low,sum_amount_high,num_users\n1,400,400,400,2\n2,20,20,20,1\n"
+    )
+
+
+def test_preview_partial_sample(tmp_path):
+    # GIVEN the file without header of 200 rows of equal length, and 10 rows per block
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text("".join(f"{UUID(int=i)},1\n" for i in range(10)))
+    (tmp_path / "transactions.csv").write_text(
+        "".join(f"{UUID(int=1000 + i)},2022-01-01,{UUID(int=i % 10)},0,{i % 7 + 1},{i % 2 + 1}\n" for i in range(200))
+    )
+
+    want = main(path_users, path_transactions, skip_header=False)
+    assert want.__str__() == "transaction_category_id,sum_amount,num_users\n2,398,5\n1,396,5\n"
+
+    # WHEN a half of blocks is sampled, the first block included
+    got = preview(path_users, path_transactions, skip_header=False, sample_fraction=0.5, block_size=910, seed=4)
+
+    # THEN the exact totals are within the confidence intervals
+    assert sorted(got.keys()) == [1, 2]
+    for k, v in got.items():
+        assert v.sum_amount_low <= want[k].sum_amount <= v.sum_amount_high
+        assert 0 < v.sum_amount_high - v.sum_amount_low < want[k].sum_amount / 4
+        assert v.num_users == 5
+
+
+def test_preview_coverage(tmp_path):
+    # GIVEN the file without header of 2000 rows of equal length with random amounts, and 10 rows per block
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    rnd = random.Random(0)
+    (tmp_path / "users.csv").write_text("".join(f"{UUID(int=i)},1\n" for i in range(10)))
+    (tmp_path / "transactions.csv").write_text(
+        "".join(
+            f"{UUID(int=1000 + i)},2022-01-01,{UUID(int=i % 10)},0,{rnd.randint(1, 9)},{i % 2 + 1}\n"
+            for i in range(2000)
+        )
+    )
+
+    want = main(path_users, path_transactions, skip_header=False)
+
+    # WHEN 4 of 200 blocks are sampled with different seeds
+    hits: list[bool] = []
+    for seed in range(100):
+        got = preview(path_users, path_transactions, skip_header=False, sample_fraction=0.02, block_size=910, seed=seed)
+        hits.extend(got[k].sum_amount_low <= v.sum_amount <= got[k].sum_amount_high for k, v in want.items())
+
+    # THEN the 95% confidence intervals contain the exact totals close to the nominal rate
+    assert sum(hits) / len(hits) >= 0.9
+
+
+@pytest.mark.parametrize(
+    "p,df,want",
+    [
+        (0.975, 1, 12.706),
+        (0.975, 2, 4.303),
+        (0.975, 3, 3.182),
+        (0.975, 9, 2.262),
+        (0.95, 30, 1.697),
+        (0.025, 4, -2.776),
+    ],
+)
+def test_t_quantile(p, df, want):
+    assert t_quantile(p, df) == pytest.approx(want, rel=5e-3)
+
+
+def test_SamplingProfiler(tmp_path):
+    path = tmp_path / "profile.collapsed"
+
+    def busy_loop() -> int:
+        o = 0
+        t0 = time.process_time()
+        while time.process_time() - t0 < 0.2:
+            o += 1
+        return o
+
+    with SamplingProfiler(str(path), interval=0.001):
+        busy_loop()
+
+    lines = path.read_text().splitlines()
+
+    assert len(lines) > 0
+    assert any("test_SamplingProfiler" in line and "busy_loop" in line for line in lines)
+    assert all(line.rsplit(" ", 1)[1].isdigit() for line in lines), "the collapsed format is expected"
+
+
+def test_SamplingProfiler_restores_signal_handler(tmp_path):
+    # GIVEN the SIGPROF handler installed by another profiler
+    def handler(signum, frame):
+        pass
+
+    previous = signal.signal(signal.SIGPROF, handler)
+
+    try:
+        # WHEN the sampling is stopped
+        with SamplingProfiler(str(tmp_path / "profile.collapsed")):
+            assert signal.getsignal(signal.SIGPROF) is not handler
+
+        # THEN the handler is restored
+        assert signal.getsignal(signal.SIGPROF) is handler
+    finally:
+        signal.signal(signal.SIGPROF, previous)
+
+
+def test_AllocationTracer(tmp_path):
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    with AllocationTracer(str(tmp_path / "snapshots")):
+        main(str(tmp_path / "users.csv"), str(tmp_path / "transactions.csv"), plan=PLAN_BUILD_USERS)
+
+    assert sorted(os.listdir(tmp_path / "snapshots")) == [
+        "01_read_active_users.tracemalloc",
+        "02_join.tracemalloc",
+        "03_calculate.tracemalloc",
+    ]
+
+
+@pytest.mark.parametrize("path_db", [":memory:", "foo.db"])
+def test_main_sqlite(tmp_path, path_db):
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+    path_db = path_db if path_db == ":memory:" else str(tmp_path / path_db)
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # THEN the sqlite engine yields the same results as the python engine
+    for _ in range(2):
+        assert (
+            main(path_users, path_transactions, engine=ENGINE_SQLITE, path_db=path_db).__str__()
+            == main(path_users, path_transactions).__str__()
+        )
+
+    assert main_sqlite(path_users, path_transactions, date_from=date(2022, 2, 1), path_db=path_db).__str__() == (
+        "transaction_category_id,sum_amount,num_users\n1,200,1\n2,20,1\n"
+    )
+
+    # WHEN the data are not valid
+    # THEN the error is raised
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace(",20,2", ",foo,2"))
+
+    with pytest.raises(DataQualityError, match="failed to decode transaction_amount"):
+        main_sqlite(path_users, path_transactions, path_db=path_db)
+
+
+@pytest.mark.parametrize(
+    "old,new,want",
+    [
+        ("ca0d184e-7297-4ac2-95a6-6ed719a67b0a", "foo", "failed to decode transaction_id"),
+        ("2022-02-02,b1ee6da9", "2022-13-02,b1ee6da9", "failed to decode date"),
+        ("ca0d184e-7297-4ac2-95a6-6ed719a67b0a,", "", "wrong number of columns"),
+    ],
+)
+def test_main_engines_invalid_row(tmp_path, old, new, want):
+    # GIVEN an invalid non-blocked row
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace(old, new))
+
+    # THEN both engines fail on the row
+    for engine in (ENGINE_PYTHON, ENGINE_SQLITE):
+        with pytest.raises(DataQualityError, match=want):
+            main(path_users, path_transactions, engine=engine)
+
+
+def test_main_engines_invalid_inactive_user(tmp_path):
+    # GIVEN an invalid inactive user
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV + "foo,0\n")
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV)
+
+    # THEN both engines skip the user
+    assert (
+        main(path_users, path_transactions, engine=ENGINE_SQLITE).__str__()
+        == main(path_users, path_transactions).__str__()
+        == "transaction_category_id,sum_amount,num_users\n1,400,2\n2,20,1\n"
+    )
+
+    # WHEN the active user is invalid
+    (tmp_path / "users.csv").write_text(USERS_CSV + "foo,1\n")
+
+    # THEN both engines fail with the same error
+    for engine in (ENGINE_PYTHON, ENGINE_SQLITE):
+        with pytest.raises(DataQualityError, match="failed to decode user_id in row 4"):
+            main(path_users, path_transactions, engine=engine)
+
+
+@pytest.mark.parametrize("plan", [PLAN_BUILD_USERS, PLAN_BUILD_TRANSACTIONS])
+def test_main_engines_no_active_users(tmp_path, plan):
+    # GIVEN no active users, and an invalid transaction
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV.replace(",1\n", ",0\n").replace(",true\n", ",false\n"))
+    (tmp_path / "transactions.csv").write_text(TRANSACTIONS_CSV.replace(",20,2", ",foo,2"))
+
+    # THEN both engines return no results without reading the transactions
+    assert main(path_users, path_transactions, plan=plan) is None
+    assert main(path_users, path_transactions, engine=ENGINE_SQLITE) is None
+
+
+def test_main_engines_invalid_blocked_row(tmp_path):
+    # GIVEN an invalid blocked row
+    path_users = str(tmp_path / "users.csv")
+    path_transactions = str(tmp_path / "transactions.csv")
+
+    (tmp_path / "users.csv").write_text(USERS_CSV)
+    (tmp_path / "transactions.csv").write_text(
+        TRANSACTIONS_CSV.replace("ce861100-26f0-4f1a-a8e3-8d6b3ad7a0e8,2022-01-01", "foo,2022-13-01")
+    )
+
+    # THEN both engines skip the row
+    assert (
+        main(path_users, path_transactions, engine=ENGINE_SQLITE).__str__()
+        == main(path_users, path_transactions).__str__()
+        == "transaction_category_id,sum_amount,num_users\n1,400,2\n2,20,1\n"
+    )